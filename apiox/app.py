@@ -1,4 +1,5 @@
 import asyncio
+import concurrent.futures
 import contextlib
 
 import functools
@@ -12,6 +13,16 @@ import jinja2
 from sqlalchemy.orm import sessionmaker
 
 from apiox.core import middleware
+from apiox.core.cache import TTLCache, SingleFlight
+from apiox.core.db import AsyncSession, EffectiveScopeCache
+from apiox.core.grouper import GrouperMembershipCache
+from apiox.core.ldap import LDAP, AsyncLDAP, CachingLDAP
+from apiox.core.purge import Purger, PURGES, PARTITIONED_PURGES
+from apiox.core.revocation import RevocationList
+from apiox.core.shared_cache import RedisSharedCache
+from apiox.core.signing import Signer
+from apiox.core.stats import LatencyStats
+from apiox.core.token import TokenHasher
 from apiox.core.handlers import grant as grant_handlers
 
 default_middlewares = (
@@ -46,6 +57,13 @@ def session_context(app):
     return cm
 
 
+def async_session_factory(app):
+    Session = sessionmaker(bind=app['db'])
+    def factory():
+        return AsyncSession(Session, loop=app.loop, executor=app['db-executor'])
+    return factory
+
+
 @asyncio.coroutine
 def create_app(*,
                api_names,
@@ -55,12 +73,42 @@ def create_app(*,
                default_realm='EXAMPLE.ORG',
                auth_realm='example.org',
                ldap=None,
+               ldap_timeout=10,
+               ldap_cache_ttl=300,
+               ldap_negative_cache_ttl=60,
+               ldap_cache_size=10000,
                db=None,
                grouper=None,
-               token_salt=''):
+               redis_address=None,
+               shared_cache=None,
+               shared_cache_ttl=300,
+               api_reload_interval=60,
+               grouper_cache_ttl=300,
+               grouper_stale_ttl=3600,
+               grouper_cache_size=100000,
+               db_threads=10,
+               negotiate_threads=4,
+               negotiate_session_keys=(),
+               negotiate_session_lifetime=300,
+               token_salt='',
+               token_hash_keys=(),
+               signed_access_token_keys=(),
+               token_revocation_interval=30,
+               principal_cache_size=10000,
+               principal_cache_ttl=60,
+               token_cache_size=10000,
+               token_cache_ttl=60,
+               scope_cache_size=10000,
+               scope_cache_ttl=300,
+               purge_interval=300,
+               purge_batch_size=1000,
+               purge_batch_delay=0.1,
+               token_partitions=False,
+               token_partitions_ahead=3):
 
     app = aiohttp.web.Application(middlewares=middlewares)
     app.on_response_prepare.append(middleware.add_negotiate_token)
+    app.on_response_prepare.append(middleware.add_negotiate_session_cookie)
     app.on_response_prepare.append(middleware.persist_bearer_token_query_param)
     app.on_response_prepare.append(middleware.add_cors_headers)
 
@@ -72,14 +120,85 @@ def create_app(*,
     app['default-realm'] = default_realm
 
     # External services
+    async_ldap = ldap
+    if isinstance(ldap, LDAP):
+        async_ldap = AsyncLDAP(ldap.url, ldap.user, timeout=ldap_timeout, loop=app.loop)
+    if async_ldap is not None and ldap_cache_ttl:
+        async_ldap = CachingLDAP(async_ldap,
+                                 ttl=ldap_cache_ttl,
+                                 negative_ttl=ldap_negative_cache_ttl,
+                                 max_size=ldap_cache_size,
+                                 loop=app.loop)
     app['ldap'] = ldap
+    app['async-ldap'] = async_ldap
     app['db'] = db
     app['db-session'] = session_context(app)
+    app['db-executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=db_threads)
+    app['db-async-session'] = async_session_factory(app)
     app['grouper'] = grouper
+    app['grouper-memberships'] = GrouperMembershipCache(grouper,
+                                                        ttl=grouper_cache_ttl,
+                                                        stale_ttl=grouper_stale_ttl,
+                                                        max_size=grouper_cache_size,
+                                                        loop=app.loop)
+    app['principal-provisioning'] = SingleFlight(loop=app.loop)
+
+    # Kerberos acceptor credentials, by listening address
+    app['negotiate-credentials'] = {}
+    app['negotiate-executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=negotiate_threads)
+    app['negotiate-stats'] = LatencyStats()
+    # Signs cookies that save browsers redoing the handshake on each request
+    if negotiate_session_keys and negotiate_session_lifetime:
+        app['negotiate-session-signer'] = Signer(negotiate_session_keys)
+    else:
+        app['negotiate-session-signer'] = None
+    app['negotiate-session-lifetime'] = negotiate_session_lifetime
+
+    if shared_cache is None and redis_address:
+        shared_cache = yield from RedisSharedCache.connect(redis_address,
+                                                           ttl=shared_cache_ttl,
+                                                           loop=app.loop)
+    app['shared-cache'] = shared_cache
+    # Without a shared cache, API changes made elsewhere are picked up by polling
+    app['api-reload-interval'] = api_reload_interval
 
     app.register_on_finish(lambda app: grouper.close())
+    if shared_cache is not None:
+        app.register_on_finish(lambda app: shared_cache.close())
+    if async_ldap is not None and async_ldap is not ldap:
+        app.register_on_finish(lambda app: async_ldap.close())
+    app.register_on_finish(lambda app: app['db-executor'].shutdown(wait=False))
+    app.register_on_finish(lambda app: app['negotiate-executor'].shutdown(wait=False))
 
     app['token-salt'] = token_salt
+    # Pass token_salt=None once no tokens hashed without HMAC keys remain
+    app['token-hasher'] = TokenHasher(token_hash_keys, legacy_salt=token_salt)
+    # Self-verifying access tokens, which are checked without the database
+    if signed_access_token_keys:
+        app['access-token-signer'] = Signer(signed_access_token_keys)
+        app['token-revocations'] = RevocationList(interval=token_revocation_interval)
+    else:
+        app['access-token-signer'] = None
+        app['token-revocations'] = None
+    if principal_cache_ttl:
+        app['principal-cache'] = TTLCache(max_size=principal_cache_size, ttl=principal_cache_ttl)
+    else:
+        app['principal-cache'] = None
+    if token_cache_ttl:
+        app['token-cache'] = TTLCache(max_size=token_cache_size, ttl=token_cache_ttl)
+    else:
+        app['token-cache'] = None
+    app['purger'] = Purger(batch_size=purge_batch_size,
+                           batch_delay=purge_batch_delay,
+                           interval=purge_interval,
+                           purges=PARTITIONED_PURGES if token_partitions else PURGES)
+    # Whether token and token_scope are partitioned by expiry (PostgreSQL 13+)
+    app['token-partitions'] = token_partitions
+    app['token-partitions-ahead'] = token_partitions_ahead
+    if scope_cache_ttl:
+        app['scope-cache'] = EffectiveScopeCache(max_size=scope_cache_size, ttl=scope_cache_ttl)
+    else:
+        app['scope-cache'] = None
 
     aiohttp_jinja2.setup(app,
                          loader=jinja2.PackageLoader('apiox.core'),
@@ -18,8 +18,12 @@ def _create_grant_handlers():
 def setup(app):
     from . import command
     from . import handlers
+    from .routing import RoutingTable
+    from .scopes import ScopeRegistry
 
     app['oauth2-grant-handlers'] = _create_grant_handlers()
+    app['api-routes'] = RoutingTable()
+    app['scope-registry'] = ScopeRegistry()
 
     app['schemas'][api_id] = get_schemas(app)
 
@@ -31,11 +35,18 @@ def setup(app):
     app.router.add_route('*', '/token',
                          handlers.TokenRequestHandler(),
                          name='oauth2:token')
+    app.router.add_route('*', '/token/bulk',
+                         handlers.BulkTokenRequestHandler(),
+                         name='oauth2:token-bulk')
 
     app.router.add_route('*', '/token/self',
                          handlers.TokenDetailsHandler(),
                          name='token-details')
 
+    app.router.add_route('*', '/stats',
+                         handlers.StatsHandler(),
+                         name='stats')
+
     app.router.add_route('*', '/api',
                          handlers.api.APIListHandler(),
                          name='api:list')
@@ -66,6 +77,11 @@ def setup(app):
     app['commands']['create_models'] = command.create_models
     app['commands']['shell'] = command.shell
     app['commands']['declare_apis'] = command.declare_apis
+    app['commands']['benchmark_tokens'] = command.benchmark_tokens
+    app['commands']['purge_expired'] = command.purge_expired
+    app['commands']['maintain_token_partitions'] = command.maintain_token_partitions
+    app['commands']['add_missing_indexes'] = command.add_missing_indexes
+    app['commands']['check_query_plans'] = command.check_query_plans
 
 
 def declare_api(session):
@@ -91,5 +107,9 @@ def declare_api(session):
             'title': 'Manage APIs',
             'description': 'Allows access to manage and register APIs',
             'grantedToUser': True,
+        }, {
+            'id': '/stats',
+            'title': 'View gateway statistics',
+            'description': 'Allows access to counters and timings for authentication and caches.',
         }]
     }))
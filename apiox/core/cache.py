@@ -0,0 +1,98 @@
+import asyncio
+import collections
+import threading
+import time
+
+__all__ = ['TTLCache', 'SingleFlight']
+
+
+class TTLCache(object):
+    """
+    A size-bounded LRU mapping whose entries expire after a time-to-live.
+
+    Entries may be given a shorter lifetime than the cache default when they're
+    set, but never a longer one.
+
+    Caches are shared between the event loop and the database executor's
+    threads, so every operation holds a lock.
+    """
+
+    def __init__(self, max_size=1024, ttl=60, clock=time.monotonic):
+        self.max_size, self.ttl, self.clock = max_size, ttl, clock
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires <= self.clock():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            if ttl <= 0:
+                self._data.pop(key, None)
+                return
+            self._data[key] = (self.clock() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight(object):
+    """
+    Lets concurrent callers asking for the same thing share one call.
+
+    The first call to do() for a key runs the coroutine function it's given;
+    calls for that key made before it completes wait for, and get, the same
+    result.
+    """
+
+    def __init__(self, loop=None):
+        self._loop = loop
+        self._pending = {}
+        self.coalesced = 0
+
+    @asyncio.coroutine
+    def do(self, key, func, *args, **kwargs):
+        try:
+            task = self._pending[key]
+        except KeyError:
+            task = self._pending[key] = asyncio.ensure_future(func(*args, **kwargs), loop=self._loop)
+            task.add_done_callback(lambda task: self._pending.pop(key, None))
+        else:
+            self.coalesced += 1
+        # Cancelling one caller shouldn't cancel the call for everyone else
+        return (yield from asyncio.shield(task, loop=self._loop))
+
+    def __contains__(self, key):
+        return key in self._pending
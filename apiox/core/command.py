@@ -1,27 +1,16 @@
 def create_models(app):
     from .db import Base
-    Base.metadata.create_all(app['db'])
+    if app.get('token-partitions'):
+        from .partitions import create_partitioned_tables
+        with app['db'].begin() as connection:
+            create_partitioned_tables(connection)
+    else:
+        Base.metadata.create_all(app['db'])
 
 
 def run_server(app):
-    import asyncio
-    import os
-
-    import logging
-    logger = logging.getLogger('apiox.server')
-
-    loop = asyncio.get_event_loop()
-
-    listen_host, listen_port = os.environ['LISTEN_HOST'], int(os.environ.get('LISTEN_PORT', 8000))
-    logger.info("Server starting on %s:%d", listen_host, listen_port)
-    f = loop.create_server(app.make_handler(), listen_host, listen_port)
-
-    srv = loop.run_until_complete(f)
-    try:
-        loop.run_forever()
-    except KeyboardInterrupt:
-        pass
-    logger.info("Server finished.")
+    from . import server
+    server.run(app)
 
 def shell(app):
     import code
@@ -37,3 +26,74 @@ def declare_apis(app):
         for api in app['apis']:
             if hasattr(api, 'declare_api'):
                 api.declare_api(session)
+
+
+def benchmark_tokens(app):
+    import random
+    import timeit
+    from .token import TOKEN_ALPHABET, TOKEN_LENGTH, generate_token
+
+    def generate_token_with_random_choice():
+        return ''.join(random.choice(TOKEN_ALPHABET) for _ in range(TOKEN_LENGTH))
+
+    number = 100000
+    for name, func in (('random.choice', generate_token_with_random_choice),
+                       ('generate_token', generate_token)):
+        duration = timeit.timeit(func, number=number)
+        print("{:>16}: {:.2f}µs per token".format(name, duration / number * 1e6))
+
+
+def purge_expired(app):
+    import sys
+    counts = app['purger'].run(app)
+    if counts is None:
+        print("Another process is purging; try again later.")
+        sys.exit(1)
+    for name, count in counts.items():
+        print("{:>20}: {}".format(name, count))
+
+
+def maintain_token_partitions(app):
+    from .partitions import maintain_partitions
+    with app['db'].begin() as connection:
+        created, dropped = maintain_partitions(connection, months_ahead=app['token-partitions-ahead'])
+    for name in created:
+        print("Created {}".format(name))
+    for name in dropped:
+        print("Dropped {}".format(name))
+
+
+def add_missing_indexes(app):
+    from .indexes import create_missing_indexes
+    for index in create_missing_indexes(app['db']):
+        print("Created {} on {}".format(index.name, index.table.name))
+
+
+def check_query_plans(app):
+    import json
+    import os
+    import sys
+    from .query_plans import run
+
+    # A JSON file of median times per case, written on the first run
+    baseline_path = os.environ.get('QUERY_PLANS_BASELINE')
+    baseline = None
+    if baseline_path and os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    results = run(app,
+                  scale=float(os.environ.get('QUERY_PLANS_SCALE', 1)),
+                  max_ms=float(os.environ.get('QUERY_PLANS_MAX_MS', 20)),
+                  baseline=baseline)
+    for result in results:
+        print("{:>28}: {:.2f}ms over {} queries{}".format(result.name, result.median_ms, len(result.statements),
+                                                         '' if result.failures else ', OK'))
+        for failure in result.failures:
+            print("{:>28}  FAIL: {}".format('', failure))
+
+    if baseline_path and baseline is None:
+        with open(baseline_path, 'w') as f:
+            json.dump({result.name: result.median_ms for result in results}, f, indent=2, sort_keys=True)
+    if any(result.failures for result in results):
+        sys.exit(1)
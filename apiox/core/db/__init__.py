@@ -5,7 +5,10 @@ Base = declarative_base()
 from .api import *
 from .authorization_code import *
 from .principal import *
+from .revoked_token import *
 from .scope_grant import *
+from .scope_cache import *
+from .session import *
 from .token import *
 
 def register_model(orm_mapping, model):
@@ -34,9 +34,14 @@ class AuthorizationCode(Base):
     account = relationship('Principal', foreign_keys=[account_id])
 
     granted_at = Column(DateTime())
-    expire_at = Column(DateTime())
+    expire_at = Column(DateTime(), index=True)
     token_expire_at = Column(DateTime(), nullable=True)
 
+    @classmethod
+    def get_by_code(cls, app, session, code):
+        code_hashes = app['token-hasher'].candidates(code)
+        return session.query(cls).filter(cls.code_hash.in_(code_hashes)).one()
+
     def convert_to_access_token(self, app, session):
         token = Token.create_access_token(app=app,
                                           session=session,
@@ -2,8 +2,8 @@ import asyncio
 import enum
 
 import re
-from aiogrouper import Subject, Group
 from sqlalchemy import Table, Column, Integer, String, ForeignKey
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.dialects.postgresql.base import ARRAY
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.exc import NoResultFound
@@ -11,9 +11,10 @@ from sqlalchemy_utils.types.choice import ChoiceType
 
 from apiox.core.db.scope import Scope
 from . import Base
-from .scope_grant import ScopeGrant
+from .scope_grant import ScopeGrant, scope_grant_scope
+from .snapshot import column_values, decode_values, detached, encode_values
 from .. import ldap
-from ..token import TOKEN_LENGTH, TOKEN_HASH_LENGTH, hash_token, generate_token
+from ..token import TOKEN_LENGTH, TOKEN_HASH_LENGTH, generate_token
 
 
 class PrincipalType(enum.Enum):
@@ -74,21 +75,55 @@ class Principal(Base):
     def __str__(self):
         return "{} ({})".format(self.id, self.name)
 
+    def cache(self, app):
+        cache = app.get('principal-cache')
+        if cache is not None:
+            cache.set(self.id, column_values(self))
+
+    def uncache(self, app):
+        cache, shared = app.get('principal-cache'), app.get('shared-cache')
+        if cache is not None:
+            cache.discard(self.id)
+        if shared is not None:
+            shared.invalidate_soon('principal', self.id)
+
+    @asyncio.coroutine
+    def share(self, app):
+        shared = app.get('shared-cache')
+        if shared is not None:
+            yield from shared.set('principal', self.id, encode_values(column_values(self)))
+
+    @classmethod
+    @asyncio.coroutine
+    def get_shared(cls, app, session, principal_id):
+        # Tries this worker's cache, then the one shared with other workers
+        principal = cls.get_cached(app, session, principal_id)
+        shared = app.get('shared-cache')
+        if principal is None and shared is not None:
+            values = yield from shared.get('principal', principal_id)
+            if values is not None:
+                principal = session.merge(detached(cls, decode_values(cls, values)), load=False)
+                principal.cache(app)
+        return principal
+
+    @classmethod
+    def get_cached(cls, app, session, principal_id):
+        # Never touches the database; returns None on a cache miss
+        cache = app.get('principal-cache')
+        values = cache.get(principal_id) if cache is not None else None
+        if values is None:
+            return None
+        return session.merge(detached(cls, values), load=False)
+
     def is_secret_valid(self, app, secret):
         if not self.secret_hash:
             return False
-        return hash_token(app, secret) == self.secret_hash
+        return app['token-hasher'].verify(secret, self.secret_hash)
 
-    def get_token_as_self(self, session):
-        scopes = set()
-        if self.is_person:
-            scopes.update(session.query(Scope).filter_by(granted_to_user=True).all())
-
-        granted_scope_ids = set()
-        for scope_grant in session.query(ScopeGrant).filter_by(client_id=self.id).all():
-            granted_scope_ids.update(s.id for s in scope_grant.scopes)
-        if granted_scope_ids:
-            scopes.update(session.query(Scope).filter(Scope.id.in_(granted_scope_ids)).all())
+    def get_token_as_self(self, session, scope_cache=None, scope_registry=None):
+        scopes = scope_cache.get(session, self) if scope_cache is not None else None
+        if scopes is None:
+            scopes = self._get_scopes_as_self(session, scope_cache, scope_registry)
 
         from .token import EphemeralToken
         return EphemeralToken(client_id=self.id,
@@ -98,46 +133,83 @@ class Principal(Base):
                               user_id=self.user_id,
                               scopes=list(scopes))
 
+    def _get_scopes_as_self(self, session, scope_cache=None, scope_registry=None):
+        if scope_cache is not None:
+            # Taken first, so anything that changes while we're querying
+            # invalidates what we cache
+            generation = scope_cache.generation
+
+        scopes = self._get_user_scopes(session, scope_registry) if self.is_person else set()
+
+        if scope_registry is not None and scope_registry.loaded:
+            granted_scope_ids = [scope_id for scope_id, in session.query(scope_grant_scope.c.scope_id) \
+                                     .join(ScopeGrant, ScopeGrant.id == scope_grant_scope.c.scope_grant_id) \
+                                     .filter(ScopeGrant.client_id == self.id)]
+            registered, unknown = scope_registry.get_many(session, granted_scope_ids)
+            scopes.update(registered)
+            if unknown:
+                # Declared since the registry was last loaded
+                scopes.update(session.query(Scope).filter(Scope.id.in_(unknown)).all())
+        else:
+            granted_scope_ids = set()
+            for scope_grant in session.query(ScopeGrant).filter_by(client_id=self.id).all():
+                granted_scope_ids.update(s.id for s in scope_grant.scopes)
+            if granted_scope_ids:
+                scopes.update(session.query(Scope).filter(Scope.id.in_(granted_scope_ids)).all())
+
+        if scope_cache is not None:
+            scope_cache.set(self, scopes, generation)
+        return scopes
+
     @asyncio.coroutine
-    def get_permissible_scopes_for_user(self, app, session, user_id, *, token=None, only_implicit=True):
+    def get_permissible_scopes_for_user(self, app, db, user_id, *, token=None, only_implicit=True):
         if self.is_person and user_id == self.user_id:
-            return set(session.query(Scope).filter_by(granted_to_user=True).all())
-        results = yield from self.get_permissible_scopes_for_users(app, session, [user_id],
+            return (yield from db.run(self._get_user_scopes, app.get('scope-registry')))
+        results = yield from self.get_permissible_scopes_for_users(app, db, [user_id],
                                                                    token=token,
                                                                    only_implicit=only_implicit)
         scopes = results.popitem()[1]
 
         return scopes
 
-    @asyncio.coroutine
-    def get_permissible_scopes_for_users(self, app, session, user_ids, *, token=None, only_implicit=True):
+    def _get_user_scopes(self, session, scope_registry=None):
+        if scope_registry is not None and scope_registry.loaded:
+            return scope_registry.user_scopes(session)
+        return set(session.query(Scope).filter_by(granted_to_user=True).all())
+
+    def _get_scope_grants(self, session, only_implicit, scope_registry=None):
         scope_grants = list(self.scope_grants)
         if only_implicit is False:
             scope_grants.extend(self.scope_request_grants)
+        user_scopes = self._get_user_scopes(session, scope_registry) if self.is_person else set()
+        return [(scope_grant.target_groups, set(scope_grant.scopes)) for scope_grant in scope_grants], user_scopes
+
+    @asyncio.coroutine
+    def get_permissible_scopes_for_users(self, app, db, user_ids, *, token=None, only_implicit=True):
+        scope_grants, user_scopes = yield from db.run(self._get_scope_grants, only_implicit,
+                                                      app.get('scope-registry'))
 
         target_groups = set()
         universal_scopes = set()
-        for scope_grant in scope_grants:
-            if scope_grant.target_groups is None:
-                universal_scopes.update(scope_grant.scopes)
+        for grant_target_groups, grant_scopes in scope_grants:
+            if grant_target_groups is None:
+                universal_scopes.update(grant_scopes)
             else:
-                target_groups |= set(scope_grant.target_groups)
+                target_groups |= set(grant_target_groups)
 
-        memberships = yield from app['grouper'].get_memberships(members=[Subject(id=u) for u in user_ids],
-                                                                groups=[Group(self._app['grouper'], uuid=g) for g in target_groups])
+        memberships = yield from app['grouper-memberships'].get_memberships(user_ids, target_groups)
         result = {}
-        for subject, in_groups in memberships.items():
-            in_groups = set(g.uuid for g in in_groups)
+        for user_id, in_groups in memberships.items():
             scopes = universal_scopes.copy()
-            if self.is_person and int(subject.id) == self.user_id:
-                scopes.update(session.query(Scope).filter_by(granted_to_user=True).all())
-            if token is not None and token.user_id == int(subject.id):
+            if self.is_person and user_id == self.user_id:
+                scopes.update(user_scopes)
+            if token is not None and token.user_id == user_id:
                 scopes.update(token.scopes)
-            for scope_grant in scope_grants:
-                if scope_grant.target_groups is not None and \
-                   in_groups & set(scope_grant.target_groups):
-                    scopes |= set(scope_grant.scopes)
-            result[int(subject.id)] = scopes
+            for grant_target_groups, grant_scopes in scope_grants:
+                if grant_target_groups is not None and \
+                   in_groups & set(grant_target_groups):
+                    scopes |= grant_scopes
+            result[user_id] = scopes
         return result
 
     @property
@@ -145,36 +217,62 @@ class Principal(Base):
         return self.type in person_principal_types
 
     @classmethod
-    def lookup(cls, app, session, *, id=None, name=None):
+    @asyncio.coroutine
+    def lookup(cls, app, db, *, id=None, name=None):
+        if id is not None:
+            principal = yield from cls.get_shared(app, db.session, id)
+            if principal is None:
+                principal = yield from db.run(lambda session: session.query(cls).filter_by(id=id).first())
+                if principal is not None:
+                    principal.cache(app)
+                    yield from principal.share(app)
+            return principal
+        elif name is None:
+            raise TypeError
 
+        if '@' not in name:
+            name = name + '@' + app['default-realm']
         try:
-            if id is not None:
-                principal = session.query(cls).filter_by(id=id).first()
-            elif name is not None:
-                if '@' not in name:
-                    name = name + '@' + app['default-realm']
-                principal = session.query(cls).filter_by(name=name).one()
-            else:
-                raise TypeError
+            return (yield from db.run(lambda session: session.query(cls).filter_by(name=name).one()))
         except NoResultFound:
-            try:
-                data = app['ldap'].get_principal(name)
-            except ldap.NoSuchLDAPObject:
-                data = {}
-            user_id = ldap.parse_person_dn(data['oakPerson'][0]) if 'oakPerson' in data else None
-
-            principal = Principal(id=generate_token(),
-                                  name=name,
-                                  user_id=user_id,
-                                  type=cls.determine_principal_type(app, name, user_id))
-            session.add(principal)
-        return principal
+            pass
+
+        # Concurrent first logins for the same name share one provisioning job
+        principal_id = yield from app['principal-provisioning'].do(name, cls.provision, app, name)
+        return (yield from db.run(lambda session: session.query(cls).get(principal_id)))
+
+    @classmethod
+    @asyncio.coroutine
+    def provision(cls, app, name):
+        try:
+            data, person = yield from app['async-ldap'].get_principal_and_person(
+                name, attributes=ldap.PRINCIPAL_ATTRIBUTES + ldap.PERSON_ATTRIBUTES)
+        except ldap.NoSuchLDAPObject:
+            data, person = {}, None
+        user_id = ldap.parse_person_dn(data['oakPerson'][0]) if 'oakPerson' in data else None
+        principal_type = cls.determine_principal_type(name, person)
+
+        # Inserts the principal in its own transaction, or finds the one that
+        # another worker got in first with.
+        def upsert():
+            with app['db-session']() as session:
+                principal = cls(id=generate_token(),
+                                name=name,
+                                user_id=user_id,
+                                type=principal_type)
+                try:
+                    with session.begin_nested():
+                        session.add(principal)
+                except IntegrityError:
+                    principal = session.query(cls).filter_by(name=name).one()
+                return principal.id
+
+        return (yield from app.loop.run_in_executor(app['db-executor'], upsert))
 
     @classmethod
-    def determine_principal_type(cls, app, name, user_id):
+    def determine_principal_type(cls, name, user):
         name = name.split('@')[0].split('/')
         first, last = name[0], name[1] if len(name) > 1 else None
-        user = app['ldap'].get_person(user_id) if user_id else None
         if last and '.' in last:
             return PrincipalType.service
         elif not user:
@@ -0,0 +1,19 @@
+from sqlalchemy import Column, String, DateTime
+
+from . import Base
+from ..token import TOKEN_LENGTH
+
+__all__ = ['RevokedToken']
+
+
+class RevokedToken(Base):
+    """
+    Records that signed access tokens for a token issued at or before
+    `revoked_at` are no longer valid. Rows can be dropped after `expire_at`,
+    when those access tokens will have expired anyway.
+    """
+    __tablename__ = 'revoked_token'
+
+    token_id = Column(String(TOKEN_LENGTH), primary_key=True)
+    revoked_at = Column(DateTime())
+    expire_at = Column(DateTime(), index=True)
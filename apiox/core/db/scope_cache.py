@@ -0,0 +1,81 @@
+import itertools
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from ..cache import TTLCache
+from .scope import Scope, ScopeAlias
+from .scope_grant import ScopeGrant
+from .snapshot import column_values, detached
+
+__all__ = ['EffectiveScopeCache']
+
+# Committing any change to scopes or scope grants bumps the generation, which
+# invalidates everything cached before it in this process. Other processes
+# find out when their entries expire.
+_generations = itertools.count(1)
+_generation = 0
+
+_watched_classes = (Scope, ScopeAlias, ScopeGrant)
+
+
+@event.listens_for(Session, 'before_flush')
+def _before_flush(session, flush_context, instances):
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, _watched_classes):
+            session.info['scopes-changed'] = True
+            break
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    global _generation
+    if session.info.pop('scopes-changed', False):
+        _generation = next(_generations)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('scopes-changed', None)
+
+
+class EffectiveScopeCache(object):
+    """
+    Remembers the scopes a principal has when acting as itself, so that
+    Principal.get_token_as_self() needn't query for them every time.
+
+    Entries are dropped when scopes or scope grants change, or when the
+    principal's type no longer matches the one they were computed for.
+    It's used from the database executor's threads, so all state is kept in
+    a (locked) TTLCache.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    @property
+    def generation(self):
+        return _generation
+
+    def get(self, session, principal):
+        entry = self._cache.get(principal.id)
+        if entry is None:
+            return None
+        generation, principal_type, scopes = entry
+        if generation != _generation or principal_type != principal.type:
+            # Left for set() to replace; discarding it here could race with
+            # another thread that has just cached a fresh entry
+            return None
+        return [session.merge(detached(Scope, values), load=False) for values in scopes]
+
+    def set(self, principal, scopes, generation):
+        self._cache.set(principal.id, (generation,
+                                       principal.type,
+                                       tuple(column_values(scope) for scope in scopes)))
+
+    def clear(self):
+        self._cache.clear()
+
+    @property
+    def stats(self):
+        return self._cache.stats
@@ -13,12 +13,12 @@ __all__ = ['ScopeGrant', 'ScopeRequestGrant']
 
 scope_grant_scope = Table('scope_grant_scope', Base.metadata,
     Column('scope_id', String, ForeignKey('scope.id'), primary_key=True),
-    Column('scope_grant_id', Integer, ForeignKey('scope_grant.id'), primary_key=True),
+    Column('scope_grant_id', Integer, ForeignKey('scope_grant.id'), primary_key=True, index=True),
 )
 
 scope_request_grant_scope = Table('scope_request_grant_scope', Base.metadata,
     Column('scope_id', String, ForeignKey('scope.id'), primary_key=True),
-    Column('scope_request_grant_id', Integer, ForeignKey('scope_request_grant.id'), primary_key=True),
+    Column('scope_request_grant_id', Integer, ForeignKey('scope_request_grant.id'), primary_key=True, index=True),
 )
 
 
@@ -26,7 +26,7 @@ class ScopeGrant(Base):
     __tablename__ = 'scope_grant'
 
     id = Column(Integer, primary_key=True)
-    client_id = Column(String(TOKEN_LENGTH), ForeignKey('principal.id'))
+    client_id = Column(String(TOKEN_LENGTH), ForeignKey('principal.id'), index=True)
     target_groups = Column(ARRAY(String(32)))
 
     client = relationship('Principal', backref='scope_grants')
@@ -43,7 +43,7 @@ class ScopeRequestGrant(Base):
     __tablename__ = 'scope_request_grant'
 
     id = Column(Integer, primary_key=True)
-    client_id = Column(String(TOKEN_LENGTH), ForeignKey('principal.id'))
+    client_id = Column(String(TOKEN_LENGTH), ForeignKey('principal.id'), index=True)
     target_groups = Column(ARRAY(String(32)))
 
     client = relationship('Principal', backref='scope_request_grants')
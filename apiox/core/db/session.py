@@ -0,0 +1,105 @@
+import asyncio
+import functools
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+__all__ = ['AsyncSession', 'LazySession', 'on_commit']
+
+
+# Model methods that are run on the database executor can't get at the
+# AsyncSession, so use on_commit() to defer side effects until the plain
+# session's transaction is committed. Callbacks are called on the thread that
+# committed, and are dropped if the transaction is rolled back instead.
+
+def on_commit(session, callback):
+    session.info.setdefault('on-commit', []).append(callback)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    # Releasing a savepoint isn't the end of the transaction
+    if session.transaction is not None and session.transaction.nested:
+        return
+    for callback in session.info.pop('on-commit', ()):
+        callback()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('on-commit', None)
+
+
+class AsyncSession(object):
+    """
+    Wraps a SQLAlchemy session so that blocking database work is run on a thread
+    pool instead of the event loop.
+
+    Anything that might emit SQL (queries, lazy-loaded relationships, flushes)
+    should be done inside a callable passed to run(), which is given the
+    session as its first argument. Calls are serialized, so the underlying
+    session is only ever used by one thread at a time.
+
+    The session itself isn't created until it's first needed, and committing,
+    rolling back or closing an AsyncSession that never created one does
+    nothing.
+
+    Callbacks registered with after_commit() are called once the transaction
+    has been committed successfully, and dropped if it's rolled back. Any that return coroutines are waited
+    for before commit() returns.
+    """
+
+    def __init__(self, session_factory, *, loop, executor=None):
+        self._session_factory, self._session = session_factory, None
+        self._loop, self._executor = loop, executor
+        self._lock = asyncio.Lock(loop=loop)
+        self._after_commit = []
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = self._session_factory()
+        return self._session
+
+    @asyncio.coroutine
+    def run(self, func, *args, **kwargs):
+        with (yield from self._lock):
+            return (yield from self._loop.run_in_executor(self._executor,
+                                                          functools.partial(func, self.session, *args, **kwargs)))
+
+    def after_commit(self, callback):
+        self._after_commit.append(callback)
+
+    @asyncio.coroutine
+    def commit(self):
+        if self._session is not None:
+            yield from self.run(lambda session: session.commit())
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            res = callback()
+            if (asyncio.iscoroutine(res) or
+                    isinstance(res, asyncio.Future)):
+                yield from res
+
+    @asyncio.coroutine
+    def rollback(self):
+        self._after_commit = []
+        if self._session is not None:
+            yield from self.run(lambda session: session.rollback())
+
+    @asyncio.coroutine
+    def close(self):
+        if self._session is not None:
+            yield from self.run(lambda session: session.close())
+
+
+class LazySession(object):
+    """
+    Stands in for the session of an AsyncSession, creating it on first use.
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        return getattr(self._db.session, name)
@@ -0,0 +1,57 @@
+import datetime
+import enum
+
+from sqlalchemy import DateTime
+from sqlalchemy.orm import class_mapper, make_transient_to_detached, object_mapper
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy_utils.types.choice import ChoiceType
+
+# Snapshots are immutable copies of the column values of loaded rows, which can
+# be shared between sessions (and requests) without touching the database.
+# Restoring one gives a detached instance that can be attached to a session
+# with session.merge(instance, load=False), again without emitting any SQL.
+
+
+def column_values(instance):
+    return tuple((prop.key, getattr(instance, prop.key))
+                 for prop in object_mapper(instance).column_attrs)
+
+
+def detached(cls, values, **relationships):
+    instance = cls(**dict(values))
+    make_transient_to_detached(instance)
+    for key, value in relationships.items():
+        set_committed_value(instance, key, value)
+    return instance
+
+
+# Snapshots that leave the process (in cookies or a shared cache) are encoded
+# as JSON. Datetimes and enums are turned back into the right types using the
+# mapped columns' types when they're decoded.
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_values(values):
+    encoded = []
+    for key, value in values:
+        if isinstance(value, datetime.datetime):
+            value = value.strftime(_DATETIME_FORMAT)
+        elif isinstance(value, enum.Enum):
+            value = value.value
+        encoded.append([key, value])
+    return encoded
+
+
+def decode_values(cls, encoded):
+    columns = class_mapper(cls).columns
+    values = []
+    for key, value in encoded:
+        column_type = columns[key].type
+        if value is not None:
+            if isinstance(column_type, DateTime):
+                value = datetime.datetime.strptime(value, _DATETIME_FORMAT)
+            elif isinstance(column_type, ChoiceType):
+                value = column_type.choices(value)
+        values.append((key, value))
+    return tuple(values)
@@ -1,22 +1,38 @@
 import asyncio
 import datetime
+import functools
 
 import collections
 from aiohttp.web_exceptions import HTTPUnauthorized
-from sqlalchemy import Column, DateTime, String, ForeignKey, Table, Integer
+from sqlalchemy import Column, DateTime, String, ForeignKey, Table, Integer, Boolean, text, column
 from sqlalchemy.dialects.postgresql.base import ARRAY
 from sqlalchemy.orm import relationship
 
 from apiox.core.response import JSONResponse
 from . import Base
 from .principal import Principal
+from .revoked_token import RevokedToken
+from .scope import Scope
+from .session import on_commit
+from .snapshot import column_values, decode_values, detached, encode_values
+from ..signing import Signer
 from ..token import TOKEN_LENGTH, TOKEN_HASH_LENGTH, generate_token, hash_token, TOKEN_LIFETIME
 
 __all__ = ['Token', 'EphemeralToken']
 
+_SIGNED_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _format_datetime(value):
+    return value.strftime(_SIGNED_DATETIME_FORMAT) if value else None
+
+
+def _parse_datetime(value):
+    return datetime.datetime.strptime(value, _SIGNED_DATETIME_FORMAT) if value else None
+
 token_scope = Table('token_scope', Base.metadata,
     Column('scope_id', String, ForeignKey('scope.id'), primary_key=True),
-    Column('token_id', String(TOKEN_LENGTH), ForeignKey('token.id'), primary_key=True),
+    Column('token_id', String(TOKEN_LENGTH), ForeignKey('token.id'), primary_key=True, index=True),
 )
 
 class Token(Base):
@@ -33,9 +49,12 @@ class Token(Base):
     class Overused(Error):
         description = 'The token has been used its allotted number of times.'
 
+    class Revoked(Error):
+        description = 'Token revoked.'
+
     id = Column(String(TOKEN_LENGTH), primary_key=True)
-    access_token_hash = Column(String(TOKEN_HASH_LENGTH))
-    refresh_token_hash = Column(String(TOKEN_HASH_LENGTH), nullable=True)
+    access_token_hash = Column(String(TOKEN_HASH_LENGTH), index=True)
+    refresh_token_hash = Column(String(TOKEN_HASH_LENGTH), nullable=True, index=True)
     
     client_id = Column(String, ForeignKey('principal.id'))
     account_id = Column(String, ForeignKey('principal.id'))
@@ -44,17 +63,19 @@ class Token(Base):
     scopes = relationship('Scope', secondary=token_scope, backref='tokens')
 
     granted_at = Column(DateTime())
-    refresh_at = Column(DateTime())
-    expire_at = Column(DateTime(), nullable=True)
+    refresh_at = Column(DateTime(), index=True)
+    expire_at = Column(DateTime(), nullable=True, index=True)
 
     remaining_uses = Column(Integer, nullable=True)
 
     client = relationship('Principal', foreign_keys=[client_id])
     account = relationship('Principal', foreign_keys=[account_id])
 
-    parent_id = Column(String(TOKEN_LENGTH), ForeignKey('token.id'), nullable=True)
+    parent_id = Column(String(TOKEN_LENGTH), ForeignKey('token.id'), nullable=True, index=True)
     parent = relationship('Token', backref='children', remote_side=id)
 
+    Snapshot = collections.namedtuple('Snapshot', ('token', 'client', 'account', 'scopes'))
+
     def to_json(self, *, access_token=None, refresh_token=None):
         data = {'scopes': sorted(scope.id for scope in self.scopes),
                 'expires_in': round((self.refresh_at - datetime.datetime.utcnow()).total_seconds()),
@@ -91,34 +112,71 @@ class Token(Base):
         return refresh_token
 
     def refresh(self, app, session, *, scopes=None):
+        self.uncache(app, session)
+        self.revoke_signed_access_tokens(app, session)
         if scopes:
             self.scopes = list(set(self['scopes']) & set(scopes))
-        access_token = generate_token()
-        self.access_token_hash = hash_token(app, access_token)
         refresh_token = self.set_refresh(app)
+        access_token = self.issue_access_token(app)
         return access_token, refresh_token
 
+    def issue_access_token(self, app):
+        # Signed access tokens need an expiry, so non-expiring tokens get
+        # opaque ones. Use-limited tokens do too, as their uses can only be
+        # counted in the database. Either way, the hash is stored so that the
+        # token can be looked up in the database like any other.
+        signer = app.get('access-token-signer')
+        if signer is not None and self.refresh_at and self.remaining_uses is None:
+            now = datetime.datetime.utcnow()
+            access_token = signer.sign({'id': self.id,
+                                        'iat': now.strftime(_SIGNED_DATETIME_FORMAT),
+                                        'client': self.client.id,
+                                        'account': self.account.id,
+                                        'user': self.user_id,
+                                        'parent': self.parent_id,
+                                        'scopes': sorted(scope.id for scope in self.scopes),
+                                        'grantedAt': _format_datetime(self.granted_at),
+                                        'refreshAt': _format_datetime(self.refresh_at),
+                                        'expireAt': _format_datetime(self.expire_at)},
+                                       expires_in=(self.refresh_at - now).total_seconds())
+        else:
+            access_token = generate_token()
+        self.access_token_hash = hash_token(app, access_token)
+        return access_token
+
+    def revoke_signed_access_tokens(self, app, session):
+        # Signed access tokens are otherwise valid until they expire
+        if app.get('access-token-signer') is None or not self.refresh_at:
+            return
+        now = datetime.datetime.utcnow()
+        if self.refresh_at > now:
+            session.merge(RevokedToken(token_id=self.id, revoked_at=now, expire_at=self.refresh_at))
+            # Run on the database executor, so hand the revocation over to the
+            # event loop, and only once it's been committed
+            on_commit(session, functools.partial(app.loop.call_soon_threadsafe,
+                                                 app['token-revocations'].add, self.id, now, self.refresh_at))
+
     @classmethod
     def create_access_token(cls, *, app, session,
                             granted_at,
                             client, account, user_id, scopes,
                             expires=None, refreshable=True,
-                            parent=None):
+                            parent=None, remaining_uses=None):
         if expires is True:
             expires = TOKEN_LIFETIME
         if isinstance(expires, int):
             expires = datetime.datetime.utcnow() + datetime.timedelta(0, expires)
-        access_token = generate_token()
         token = cls(id=generate_token(),
-                    access_token_hash=hash_token(app, access_token),
                     client=client,
                     account=account,
                     user_id=user_id,
                     scopes=list(scopes),
                     granted_at=granted_at,
                     expire_at=expires,
+                    remaining_uses=remaining_uses,
                     parent=parent)
         refresh_token = token.set_refresh(app, refreshable)
+        access_token = token.issue_access_token(app)
         session.add(token)
         return token, (access_token, refresh_token)
 
@@ -131,25 +189,269 @@ class Token(Base):
                                               expires=self.expire_at,
                                               parent=self)
 
+    def snapshot(self):
+        return self.Snapshot(token=column_values(self),
+                             client=column_values(self.client),
+                             account=column_values(self.account),
+                             scopes=tuple(column_values(scope) for scope in self.scopes))
+
+    @staticmethod
+    def encode_snapshot(snapshot):
+        return {'token': encode_values(snapshot.token),
+                'client': encode_values(snapshot.client),
+                'account': encode_values(snapshot.account),
+                'scopes': [encode_values(scope) for scope in snapshot.scopes]}
+
+    @classmethod
+    def decode_snapshot(cls, data):
+        return cls.Snapshot(token=decode_values(cls, data['token']),
+                            client=decode_values(Principal, data['client']),
+                            account=decode_values(Principal, data['account']),
+                            scopes=tuple(decode_values(Scope, scope) for scope in data['scopes']))
+
+    @classmethod
+    def from_snapshot(cls, session, snapshot):
+        client = detached(Principal, snapshot.client)
+        if snapshot.account == snapshot.client:
+            account = client
+        else:
+            account = detached(Principal, snapshot.account)
+        token = detached(cls, snapshot.token,
+                         client=client,
+                         account=account,
+                         scopes=[detached(Scope, scope) for scope in snapshot.scopes])
+        return session.merge(token, load=False)
+
+    def cache(self, app):
+        cache = app.get('token-cache')
+        # Use-limited tokens have to hit the database every time to be counted
+        if cache is None or self.remaining_uses is not None:
+            return
+        ttl = (self.refresh_at - datetime.datetime.utcnow()).total_seconds() if self.refresh_at else None
+        cache.set(self.access_token_hash, self.snapshot(), ttl=ttl)
+
+    def uncache(self, app, session=None):
+        # Given a session, waits for its transaction to be committed, so that
+        # the old row can't be cached again in the meantime. The hash is taken
+        # now, as refreshing replaces it.
+        if session is not None:
+            on_commit(session, functools.partial(self._uncache, app, self.access_token_hash))
+        else:
+            self._uncache(app, self.access_token_hash)
+
+    @staticmethod
+    def _uncache(app, access_token_hash):
+        cache, shared = app.get('token-cache'), app.get('shared-cache')
+        if cache is not None and access_token_hash:
+            cache.discard(access_token_hash)
+        if shared is not None and access_token_hash:
+            shared.invalidate_soon('token', access_token_hash)
+
+    @asyncio.coroutine
+    def share(self, app):
+        shared = app.get('shared-cache')
+        if shared is None or self.remaining_uses is not None:
+            return
+        ttl = (self.refresh_at - datetime.datetime.utcnow()).total_seconds() if self.refresh_at else None
+        yield from shared.set('token', self.access_token_hash, self.encode_snapshot(self.snapshot()), ttl=ttl)
+
+    @classmethod
+    def authenticate_cached(cls, *, app, session, access_token):
+        # Never touches the database, so is safe to call on the event loop.
+        # Returns None if the token has to be looked up with authenticate().
+        cache = app.get('token-cache')
+        if cache is None:
+            return None
+        for access_token_hash in app['token-hasher'].candidates(access_token):
+            snapshot = cache.get(access_token_hash)
+            if snapshot is not None:
+                break
+        else:
+            return None
+        token = cls.from_snapshot(session, snapshot)
+        if token.refresh_at and token.refresh_at <= datetime.datetime.utcnow():
+            raise cls.Expired
+        return token
+
+    @classmethod
+    @asyncio.coroutine
+    def authenticate_shared(cls, *, app, session, access_token):
+        # Looks in the cache shared with other workers, and returns None on a
+        # miss
+        shared = app.get('shared-cache')
+        if shared is None:
+            return None
+        for access_token_hash in app['token-hasher'].candidates(access_token):
+            data = yield from shared.get('token', access_token_hash)
+            if data is not None:
+                break
+        else:
+            return None
+        token = cls.from_snapshot(session, cls.decode_snapshot(data))
+        if token.refresh_at and token.refresh_at <= datetime.datetime.utcnow():
+            raise cls.Expired
+        token.cache(app)
+        return token
+
+    @staticmethod
+    def is_signed(access_token):
+        # Opaque access tokens are purely alphanumeric
+        return '.' in access_token
+
+    @classmethod
+    def verify_signed(cls, app, access_token):
+        # Expects app['token-revocations'] to have been loaded
+        try:
+            claims = app['access-token-signer'].verify(access_token)
+        except Signer.Expired:
+            raise cls.Expired
+        except Signer.Invalid:
+            raise cls.NotFound
+        issued_at = datetime.datetime.strptime(claims['iat'], _SIGNED_DATETIME_FORMAT)
+        if app['token-revocations'].is_revoked(claims['id'], issued_at):
+            raise cls.Revoked
+        return claims
+
+    @classmethod
+    def authenticate_signed(cls, *, app, session, claims, load_principals=False):
+        # Doesn't touch the database unless load_principals is True, and
+        # returns None if it would have to, for principals or for scopes
+        # missing from app['scope-registry'], which is expected to have been
+        # loaded.
+
+        principals = {}
+        for principal_id in {claims['client'], claims['account']}:
+            principal = Principal.get_cached(app, session, principal_id)
+            if principal is None:
+                if not load_principals:
+                    return None
+                principal = session.query(Principal).get(principal_id)
+                if principal is None:
+                    raise cls.NotFound
+                principal.cache(app)
+            principals[principal_id] = principal
+
+        scopes, unknown = app['scope-registry'].get_many(session, claims['scopes'])
+        if unknown:
+            # Declared since the registry was last loaded
+            if not load_principals:
+                return None
+            scopes.update(session.query(Scope).filter(Scope.id.in_(unknown)).all())
+        # The hashes aren't known from the claims, but signed tokens are never
+        # cached, so nothing needs them
+        token = detached(cls, (('id', claims['id']),
+                               ('access_token_hash', None),
+                               ('refresh_token_hash', None),
+                               ('client_id', claims['client']),
+                               ('account_id', claims['account']),
+                               ('user_id', claims['user']),
+                               ('granted_at', _parse_datetime(claims['grantedAt'])),
+                               ('refresh_at', _parse_datetime(claims['refreshAt'])),
+                               ('expire_at', _parse_datetime(claims['expireAt'])),
+                               ('remaining_uses', None),
+                               ('parent_id', claims['parent'])),
+                         client=principals[claims['client']],
+                         account=principals[claims['account']],
+                         scopes=list(scopes))
+        return session.merge(token, load=False)
+
+    @classmethod
+    def get_by_refresh_token(cls, app, session, refresh_token):
+        refresh_token_hashes = app['token-hasher'].candidates(refresh_token)
+        return session.query(cls).filter(cls.refresh_token_hash.in_(refresh_token_hashes)).one()
+
     @classmethod
     def authenticate(cls, *, app, session, access_token, token_id=None):
-        authentication_scheme = 'Bearer realm="{}"'.format(app['auth-realm'])
-        access_token_hash = hash_token(app, access_token)
-        token = session.query(Token).filter_by(access_token_hash=access_token_hash).first()
-        if not token:
+        token = cls.authenticate_cached(app=app, session=session, access_token=access_token)
+        if token is not None:
+            return token
+        # Looks the token up and, if it's use-limited, counts the use, in one
+        # statement. Concurrent requests can't overspend a token, as the use
+        # count is rechecked on the row being updated.
+        now = datetime.datetime.utcnow()
+        row = session.execute(_AUTHENTICATE, {
+            'access_token_hashes': list(app['token-hasher'].candidates(access_token)),
+            'now': now,
+        }).first()
+        if row is None:
             raise cls.NotFound
-        if token.remaining_uses is not None:
-            remaining_uses = session.scalar(
-                Token.__table__.update()
-                    .where(Token.access_token_hash==access_token_hash)
-                    .values({Token.remaining_uses: Token.remaining_uses - 1})
-                    .returning(Token.remaining_uses))
-            if remaining_uses is not None and remaining_uses < 0:
-                raise cls.Overused
-        if token.refresh_at and token.refresh_at <= datetime.datetime.utcnow():
+        token = cls._from_authenticate_row(app, session, row)
+        if token.refresh_at and token.refresh_at <= now:
             raise cls.Expired
+        if token.remaining_uses is not None and not row['consumed']:
+            raise cls.Overused
+        token.cache(app)
         return token
 
+    @classmethod
+    def _from_authenticate_row(cls, app, session, row):
+        def values(prefix, table):
+            return tuple((c.key, row[prefix + c.name]) for c in table.columns)
+        token_values = dict(values('token__', cls.__table__))
+        if row['consumed']:
+            token_values['remaining_uses'] = row['consumed_remaining_uses']
+
+        client = detached(Principal, values('client__', Principal.__table__))
+        if token_values['account_id'] == token_values['client_id']:
+            account = client
+        else:
+            account = detached(Principal, values('account__', Principal.__table__))
+
+        scope_registry = app.get('scope-registry')
+        if scope_registry is not None and scope_registry.loaded:
+            scopes, unknown = scope_registry.get_many(session, row['scope_ids'])
+            if unknown:
+                # Declared since the registry was last loaded
+                scopes.update(session.query(Scope).filter(Scope.id.in_(unknown)).all())
+        elif row['scope_ids']:
+            scopes = session.query(Scope).filter(Scope.id.in_(row['scope_ids'])).all()
+        else:
+            scopes = []
+
+        token = detached(cls, token_values.items(),
+                         client=client,
+                         account=account,
+                         scopes=list(scopes))
+        return session.merge(token, load=False)
+
+
+def _authenticate_statement():
+    tables = (('token__', 'target', Token.__table__),
+              ('client__', 'client', Principal.__table__),
+              ('account__', 'account', Principal.__table__))
+    select_list = ',\n               '.join('{}.{} AS {}{}'.format(alias, c.name, prefix, c.name)
+                                          for prefix, alias, table in tables
+                                          for c in table.columns)
+    columns = [column(prefix + c.name, c.type)
+               for prefix, alias, table in tables
+               for c in table.columns]
+    columns += [column('consumed', Boolean),
+                column('consumed_remaining_uses', Integer),
+                column('scope_ids', ARRAY(String))]
+    return text("""
+        WITH target AS (
+            SELECT * FROM token WHERE access_token_hash = ANY(:access_token_hashes)
+        ), consumed AS (
+            UPDATE token SET remaining_uses = token.remaining_uses - 1
+            FROM target
+            WHERE token.id = target.id
+              AND token.remaining_uses > 0
+              AND (token.refresh_at IS NULL OR token.refresh_at > :now)
+            RETURNING token.id, token.remaining_uses
+        )
+        SELECT {select_list},
+               consumed.id IS NOT NULL AS consumed,
+               consumed.remaining_uses AS consumed_remaining_uses,
+               ARRAY(SELECT scope_id FROM token_scope WHERE token_id = target.id) AS scope_ids
+        FROM target
+        JOIN principal AS client ON client.id = target.client_id
+        JOIN principal AS account ON account.id = target.account_id
+        LEFT JOIN consumed ON consumed.id = target.id
+        LIMIT 1
+    """.format(select_list=select_list)).columns(*columns)
+
+_AUTHENTICATE = _authenticate_statement()
+
 EphemeralToken = collections.namedtuple('EphemeralToken',
                                         ('client_id', 'client',
                                          'account_id', 'account',
@@ -1,6 +1,109 @@
+import asyncio
+import logging
+import time
+
 import aiogrouper
 import aiohttp_negotiate
+from aiogrouper import Subject, Group
+
+from .cache import TTLCache, SingleFlight
+
+logger = logging.getLogger(__name__)
 
 def get_grouper(url, user):
     return aiogrouper.Grouper(url,
         session=aiohttp_negotiate.NegotiateClientSession(negotiate_client_name=user))
+
+
+class GrouperMembershipCache(object):
+    """
+    Caches whether people are members of Grouper groups, keyed by
+    (user ID, group UUID).
+
+    Misses are fetched in one batch covering every group asked about, so a
+    single lookup warms the cache for all of a client's target groups.
+    Concurrent identical fetches are coalesced.
+
+    Entries are fresh for `ttl` seconds. For `stale_ttl` seconds after that
+    they're still returned, and a background fetch is started to bring them up
+    to date, so callers don't wait on Grouper for anyone seen recently.
+    """
+
+    def __init__(self, grouper, *, ttl=300, stale_ttl=3600, max_size=100000,
+                 loop=None, clock=time.monotonic):
+        self.grouper, self.ttl, self.stale_ttl, self.clock = grouper, ttl, stale_ttl, clock
+        self._loop = loop
+        self._cache = TTLCache(max_size=max_size, ttl=ttl + stale_ttl, clock=clock)
+        self._single_flight = SingleFlight(loop=loop)
+        self.stale_hits = self.refresh_errors = 0
+
+    @asyncio.coroutine
+    def get_memberships(self, user_ids, group_uuids):
+        """
+        Returns a dict mapping each user ID to the set of the given group UUIDs
+        that user is a member of.
+        """
+        user_ids, group_uuids = set(user_ids), frozenset(group_uuids)
+        result = {user_id: set() for user_id in user_ids}
+        missing, stale = set(), set()
+        now = self.clock()
+        for user_id in user_ids:
+            for group_uuid in group_uuids:
+                entry = self._cache.get((user_id, group_uuid))
+                if entry is None:
+                    missing.add(user_id)
+                    continue
+                fetched_at, is_member = entry
+                if now - fetched_at >= self.ttl:
+                    stale.add(user_id)
+                if is_member:
+                    result[user_id].add(group_uuid)
+
+        stale -= missing
+        if stale:
+            self.stale_hits += 1
+            asyncio.ensure_future(self._refresh_in_background(stale, group_uuids), loop=self._loop)
+        if missing:
+            result.update((yield from self.refresh(missing, group_uuids)))
+        return result
+
+    @asyncio.coroutine
+    def refresh(self, user_ids, group_uuids):
+        key = (frozenset(user_ids), frozenset(group_uuids))
+        return (yield from self._single_flight.do(key, self._fetch, *key))
+
+    @asyncio.coroutine
+    def _refresh_in_background(self, user_ids, group_uuids):
+        try:
+            yield from self.refresh(user_ids, group_uuids)
+        except Exception:
+            self.refresh_errors += 1
+            logger.exception("Failed to refresh Grouper memberships")
+
+    @asyncio.coroutine
+    def _fetch(self, user_ids, group_uuids):
+        result = {user_id: set() for user_id in user_ids}
+        if not group_uuids:
+            return result
+        memberships = yield from self.grouper.get_memberships(
+            members=[Subject(id=user_id) for user_id in user_ids],
+            groups=[Group(self.grouper, uuid=group_uuid) for group_uuid in group_uuids])
+        for subject, in_groups in memberships.items():
+            result[int(subject.id)] = set(g.uuid for g in in_groups) & group_uuids
+        if self.ttl:
+            fetched_at = self.clock()
+            for user_id, in_groups in result.items():
+                for group_uuid in group_uuids:
+                    self._cache.set((user_id, group_uuid), (fetched_at, group_uuid in in_groups))
+        return result
+
+    @property
+    def stats(self):
+        stats = self._cache.stats
+        stats.update({'staleHits': self.stale_hits,
+                      'refreshErrors': self.refresh_errors,
+                      'coalesced': self._single_flight.coalesced})
+        return stats
+
+    def clear(self):
+        self._cache.clear()
@@ -2,7 +2,9 @@ from .authorize import AuthorizeHandler
 from .base import BaseHandler
 from .index import IndexHandler
 from .reverse_proxy import ReverseProxyHandler
+from .stats import StatsHandler
 from .token import TokenRequestHandler
+from .token_bulk import BulkTokenRequestHandler
 from .token_details import TokenDetailsHandler
 from . import api
 from . import client
\ No newline at end of file
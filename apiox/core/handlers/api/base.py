@@ -10,10 +10,12 @@ from .. import BaseHandler
 class APIBaseHandler(BaseHandler):
     @asyncio.coroutine
     def get_api(self, request, modifying=False):
-        api = request.session.query(API).get(request.match_info['id'])
+        api = yield from request.db.run(lambda session: session.query(API).get(request.match_info['id']))
         if not api:
             raise HTTPNotFound
-        if modifying and not api.may_administrate(getattr(request, 'token', None)):
+        may_administrate = yield from request.db.run(
+            lambda session: api.may_administrate(getattr(request, 'token', None)))
+        if modifying and not may_administrate:
             raise JSONResponse(body={'error': 'forbidden',
                                      'error_description': 'You are not an adminsitrator or do not have the required scope to manage APIs.'},
                                base=HTTPForbidden)
@@ -1,19 +1,23 @@
 import asyncio
+import re
 
-from aiohttp.web_exceptions import HTTPNotFound, HTTPConflict, HTTPNoContent, HTTPForbidden
+from aiohttp.web_exceptions import HTTPNotFound, HTTPConflict, HTTPNoContent, HTTPForbidden, HTTPBadRequest
 
 from apiox.core.db import API
 from . import APIBaseHandler
 from ..base import BaseHandler
 from apiox.core.response import JSONResponse
+from apiox.core.routing import apis_changed
 
 
 class APIDetailHandler(APIBaseHandler):
     @asyncio.coroutine
     def get(self, request):
         api = yield from self.get_api(request)
-        return JSONResponse(body=api.to_json(request.app,
-                                             may_administrate=api.may_administrate(getattr(request, 'token', None))))
+        body = yield from request.db.run(
+            lambda session: api.to_json(request.app,
+                                        may_administrate=api.may_administrate(getattr(request, 'token', None))))
+        return JSONResponse(body=body)
 
     @asyncio.coroutine
     def put(self, request):
@@ -30,14 +34,23 @@ class APIDetailHandler(APIBaseHandler):
             raise HTTPConflict
         if 'localImplementation' in definition:
             raise HTTPForbidden
-
-        request.session.merge(api)
+        for i, path in enumerate(definition.get('paths', ())):
+            try:
+                re.compile(path['sourcePath'])
+            except re.error as e:
+                raise JSONResponse(base=HTTPBadRequest,
+                                   body={'path': '/paths/{}/sourcePath'.format(i),
+                                         'message': 'Invalid regular expression: {}'.format(e)})
+
+        yield from request.db.run(lambda session: session.merge(api))
+        request.db.after_commit(lambda: apis_changed(request.app))
         return HTTPNoContent()
 
     @asyncio.coroutine
     def delete(self, request):
-        api = self.get_api(request, modifying=True)
+        api = yield from self.get_api(request, modifying=True)
         if not api:
             raise HTTPNotFound
-        request.session.delete(api)
+        yield from request.db.run(lambda session: session.delete(api))
+        request.db.after_commit(lambda: apis_changed(request.app))
         return HTTPNoContent()
@@ -1,61 +1,45 @@
 import asyncio
-from urllib.parse import urljoin
 from aiohttp.web_exceptions import HTTPNotFound, HTTPMethodNotAllowed, HTTPServiceUnavailable
-import re
 
-from apiox.core import API
 from apiox.core.handlers import ReverseProxyHandler
 
 
-def _first(*values):
-    for value in values:
-        if value is not None:
-            return value
-
 class APIDispatchHandler(ReverseProxyHandler):
     def __init__(self, app):
         super().__init__(app, target=None)
 
     def get_target_url(self, request):
-        url = urljoin(request.api.base,
-                      request.api_path['targetPath'].format(*request.api_match.groups(),
-                                                            **request.api_match.groupdict()))
+        url = request.api_route.get_target_url(request.api_match)
         if request.query_string:
             url += '?' + request.query_string
         return url
 
     @asyncio.coroutine
     def __call__(self, request):
-        api_id = request.match_info['api_id']
-        api = request.session.query(API).get(api_id)
+        routes = request.app['api-routes']
+        yield from routes.ensure_loaded(request.app)
+
+        api = routes.get(request.match_info['api_id'])
         if not api:
             raise HTTPNotFound
 
-        for path in api.paths:
-            match = re.match(path['sourcePath'], request.match_info['path'])
-            if match:
-                request.api_path = path
-                request.api_match = match
-                break
-        else:
+        route, match = api.match(request.match_info['path'])
+        if not route:
             raise HTTPNotFound
+        request.api_route, request.api_path, request.api_match = route, route.path, match
 
-        available = _first(api.available, path.get('available'), True)
-        if not available:
-            return HTTPServiceUnavailable
+        if not route.available:
+            raise HTTPServiceUnavailable
 
-        if 'allowMethods' in path and request.method.upper() not in path['allowMethods']:
+        if route.allow_methods is not None and request.method.upper() not in route.allow_methods:
             return HTTPMethodNotAllowed(method=request.method.upper(),
-                                        allowed_methods=path['allowMethods'])
-
-        require_auth = _first(path.get('requireAuth'), api.require_auth, False)
-        require_user = _first(path.get('requireUser'), api.require_user, False)
-        require_role = _first(path.get('requireRole'), api.require_role)
-        require_scope = _first(path.get('requireScope'), api.require_scope)
-        if require_auth:
-            yield from self.require_authentication(require_user=require_user,
-                                                   require_role=require_role,
-                                                   require_scope=require_scope)
+                                        allowed_methods=route.allow_methods)
+
+        if route.require_auth:
+            yield from self.require_authentication(request,
+                                                   require_user=route.require_user,
+                                                   require_role=route.require_role,
+                                                   require_scopes=route.require_scope)
 
         request.api = api
 
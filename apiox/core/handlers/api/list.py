@@ -8,7 +8,7 @@ from apiox.core.response import JSONResponse
 class APIListHandler(BaseHandler):
     @asyncio.coroutine
     def get(self, request):
-        apis = request.session.query(API).filter(API.advertise==True).all()
+        apis = yield from request.db.run(lambda session: session.query(API).filter(API.advertise==True).all())
         return JSONResponse(body={
             '_links': {
                 'self': {'href': request.app.router['api:list'].url()}
@@ -9,8 +9,8 @@ from aiohttp_jinja2 import render_template, render_string, APP_KEY
 from aiohttp.web_exceptions import HTTPBadRequest, HTTPFound, HTTPForbidden
 from sqlalchemy.orm.exc import NoResultFound
 
-from apiox.core.db import Scope
 from .. import db
+from ..ldap import PERSON_ATTRIBUTES
 from ..token import generate_token, hash_token, TOKEN_LIFETIME
 from .base import BaseHandler
 
@@ -32,7 +32,8 @@ class AuthorizeHandler(BaseHandler):
                                 "No <tt>client_id</tt> parameter provided.")
 
         try:
-            client = request.session.query(db.Principal).filter_by(id=data['client_id']).one()
+            client = yield from request.db.run(
+                lambda session: session.query(db.Principal).filter_by(id=data['client_id']).one())
         except NoResultFound:
             self.error_response(HTTPBadRequest, request,
                                 "Couldn't find client")
@@ -51,18 +52,17 @@ class AuthorizeHandler(BaseHandler):
             self.error_response(HTTPBadRequest, request,
                                 'The <tt>redirect_uri</tt> parameter was incorrect.')
         
-        scope_ids = data.get('scope', '').split()
-        if scope_ids:
-            scopes = set(request.session.query(Scope).filter(Scope.id.in_(scope_ids)).all())
-        else:
-            scopes = set()
-        if len(scopes) != len(scope_ids):
-            invalid_scopes = set(scope_ids) - set(scope.id for scope in scopes)
+        scope_registry = request.app['scope-registry']
+        if not scope_registry.loaded:
+            yield from scope_registry.load(request.app)
+        scopes, invalid_scopes = scope_registry.get_many(request.db.session,
+                                                         data.get('scope', '').split())
+        if invalid_scopes:
             self.error_response(HTTPBadRequest, request,
                                 'Invalid scopes: {}'.format(
                                     ', '.join('<tt>{}</tt>'.format(escape(s)) for s in invalid_scopes)))
         permissible_scopes = yield from client.get_permissible_scopes_for_user(request.app,
-                                                                               request.session,
+                                                                               request.db,
                                                                                request.token.user_id,
                                                                                only_implicit=False)
         disallowed_scopes = scopes - permissible_scopes
@@ -84,7 +84,9 @@ class AuthorizeHandler(BaseHandler):
         
         csrf_token = request.cookies.get('csrf-token') or generate_token()
         
-        context.update({'person': request.app['ldap'].get_person(request.token.user_id),
+        person = yield from request.app['async-ldap'].get_person(request.token.user_id,
+                                                                 attributes=PERSON_ATTRIBUTES)
+        context.update({'person': person,
                         'token': request.token,
                         'csrf_token': csrf_token})
         
@@ -118,7 +120,7 @@ class AuthorizeHandler(BaseHandler):
                                                       granted_at=datetime.datetime.utcnow(),
                                                       expire_at=datetime.datetime.utcnow() + datetime.timedelta(0, 60),
                                                       token_expire_at=token_expire_at)
-            request.session.add(authorization_code)
+            request.db.session.add(authorization_code)
 
             params = {'code': code}
             if context['state']:
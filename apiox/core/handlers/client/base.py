@@ -12,8 +12,11 @@ __all__ = ['BaseClientHandler']
 class BaseClientHandler(BaseHandler):
     @asyncio.coroutine
     def get_client(self, request, modifying=False):
-        client = request.session.query(Principal).filter_by(id=request.match_info['id']).one()
-        if modifying and not client.may_administrate(getattr(request, 'token', None)):
+        client = yield from request.db.run(
+            lambda session: session.query(Principal).filter_by(id=request.match_info['id']).one())
+        may_administrate = yield from request.db.run(
+            lambda session: client.may_administrate(getattr(request, 'token', None)))
+        if modifying and not may_administrate:
             raise JSONResponse(body={'error': 'forbidden',
                                      'error_description': 'You are not an adminsitrator or do not have the required scope to manage clients.'},
                                base=HTTPForbidden)
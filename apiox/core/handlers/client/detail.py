@@ -25,8 +25,9 @@ class ClientDetailHandler(BaseClientHandler):
     def get(self, request):
         yield from self.require_authentication(request)
         client = yield from self.get_client(request)
-        may_administrate = client.may_administrate(getattr(request, 'token', None))
-        body = client.client_to_json(request.app, may_administrate=may_administrate)
+        body = yield from request.db.run(
+            lambda session: client.client_to_json(request.app,
+                                                  may_administrate=client.may_administrate(getattr(request, 'token', None))))
 
         return JSONResponse(
             body=body,
@@ -42,7 +43,8 @@ class ClientDetailHandler(BaseClientHandler):
         client.description = body.get('description')
         client.redirect_uris = body.get('redirectURIs', [])
         client.allowed_oauth2_grant_types = body.get('oauth2GrantTypes', [])
-        request.session.add(client)
+        request.db.session.add(client)
+        request.db.after_commit(lambda: client.uncache(request.app))
         return HTTPNoContent()
 
 
@@ -53,7 +55,8 @@ class ClientSecretHandler(BaseClientHandler):
         client = yield from self.get_client(request, modifying=True)
         secret = generate_token()
         client.secret_hash = hash_token(request.app, secret)
-        request.session.add(client)
+        request.db.session.add(client)
+        request.db.after_commit(lambda: client.uncache(request.app))
         return JSONResponse(
             body={'secret': secret},
             headers={'Pragma': 'no-cache'},
@@ -64,5 +67,6 @@ class ClientSecretHandler(BaseClientHandler):
         yield from self.require_authentication(request)
         client = yield from self.get_client(request, modifying=True)
         client.secret_hash = None
-        request.session.add(client)
+        request.db.session.add(client)
+        request.db.after_commit(lambda: client.uncache(request.app))
         return HTTPNoContent()
@@ -14,9 +14,11 @@ class ClientListHandler(BaseClientHandler):
     @asyncio.coroutine
     def get(self, request):
         yield from self.require_authentication(request, require_scopes={'/oauth2/manage-client'})
+        items = yield from request.db.run(
+            lambda session: [p.client_to_json(request.app, True) for p in request.token.account.administrator_of])
         body = {
             '_embedded': {
-                'item': [p.client_to_json(request.app, True) for p in request.token.account.administrator_of],
+                'item': items,
             },
         },
         return JSONResponse(body=body)
@@ -26,5 +28,5 @@ class ClientListHandler(BaseClientHandler):
         yield from self.require_authentication(request, require_scopes={'/oauth2/manage-client'})
         client = Principal(id=generate_token())
         client.administrators = [request.token.account]
-        request.session.add(client)
+        request.db.session.add(client)
         return HTTPCreated(headers={'Location': request.app.router['client:detail'].url(parts={'id': client.id})})
\ No newline at end of file
@@ -8,7 +8,6 @@ from ...response import JSONResponse
 
 from .base import BaseGrantHandler
 from aiohttp.web_exceptions import HTTPBadRequest, HTTPForbidden
-from apiox.core.token import hash_token
 
 class AuthorizationCodeGrantHandler(BaseGrantHandler):
     @asyncio.coroutine
@@ -22,9 +21,9 @@ class AuthorizationCodeGrantHandler(BaseGrantHandler):
                                   {'error': 'invalid_request',
                                    'error_description': "Missing `code` parameter"})
         
-        code_hash = hash_token(request.app, code)
         try:
-            code = request.session.query(db.AuthorizationCode).filter_by(code_hash=code_hash).one()
+            code = yield from request.db.run(
+                lambda session: db.AuthorizationCode.get_by_code(request.app, session, code))
         except NoResultFound:
             self.oauth2_exception(HTTPForbidden, request,
                                   {'error': 'access_denied',
@@ -40,7 +39,7 @@ class AuthorizationCodeGrantHandler(BaseGrantHandler):
                                   {'error': 'access_denied',
                                    'error_description': 'Incorrect `redirect_uri` specified'})
 
-        token, (access_token, refresh_token) = code.convert_to_access_token(request.app,
-                                                                            request.session)
+        token, (access_token, refresh_token) = yield from request.db.run(
+            lambda session: code.convert_to_access_token(request.app, session))
         return JSONResponse(body=token.to_json(access_token=access_token,
                                                refresh_token=refresh_token))
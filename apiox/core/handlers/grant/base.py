@@ -22,13 +22,16 @@ class BaseGrantHandler(BaseHandler):
                 except KeyError:
                     raise e
             try:
-                client = request.session.query(db.Principal).filter_by(id=client_id).one()
+                client = yield from request.db.run(
+                    lambda session: session.query(db.Principal).filter_by(id=client_id).one())
                 if not client.is_secret_valid(request.app, client_secret):
                     raise NoResultFound
             except NoResultFound:
                 self.oauth2_exception(HTTPUnauthorized, request,
                                       {'error': 'invalid_client'})
-            request.token = client.get_token_as_self(request.session)
+            request.token = yield from request.db.run(client.get_token_as_self,
+                                                      request.app['scope-cache'],
+                                                      request.app.get('scope-registry'))
         if not request.token.client.allowed_oauth2_grant_types:
             self.oauth2_exception(HTTPForbidden, request,
                                   {'error': 'unauthorized_client',
@@ -16,15 +16,15 @@ class ClientCredentialsGrantHandler(BaseGrantHandler):
             return JSONResponse(body={'error': 'access_denied',
                                       'error_description': 'Client and account must match'},
                                 base=HTTPForbidden)
-        token, (access_token, refresh_token) = \
-            db.Token.create_access_token(app=request.app,
-                                         session=request.session,
-                                         granted_at=datetime.datetime.utcnow(),
-                                         client=request.token.client,
-                                         account=request.token.account,
-                                         user_id=request.token.user_id,
-                                         scopes=self.determine_scopes(request),
-                                         expires=True,
-                                         refreshable=False)
+        token, (access_token, refresh_token) = yield from request.db.run(
+            lambda session: db.Token.create_access_token(app=request.app,
+                                                         session=session,
+                                                         granted_at=datetime.datetime.utcnow(),
+                                                         client=request.token.client,
+                                                         account=request.token.account,
+                                                         user_id=request.token.user_id,
+                                                         scopes=self.determine_scopes(request),
+                                                         expires=True,
+                                                         refreshable=False))
         return JSONResponse(body=token.to_json(access_token=access_token,
                                                refresh_token=refresh_token))
@@ -8,7 +8,6 @@ from ...response import JSONResponse
 
 from .base import BaseGrantHandler
 from aiohttp.web_exceptions import HTTPBadRequest, HTTPForbidden
-from apiox.core.token import hash_token
 
 
 class RefreshTokenGrantHandler(BaseGrantHandler):
@@ -23,9 +22,9 @@ class RefreshTokenGrantHandler(BaseGrantHandler):
                                   {'error': 'invalid_request',
                                    'error_description': "Missing `refresh_token` parameter"})
         
-        refresh_token_hash = hash_token(request.app, refresh_token)
         try:
-            token = request.session.query(db.Token).filter_by(refresh_token_hash=refresh_token_hash).one()
+            token = yield from request.db.run(
+                lambda session: db.Token.get_by_refresh_token(request.app, session, refresh_token))
         except NoResultFound:
             self.oauth2_exception(HTTPForbidden, request,
                                   {'error': 'access_denied',
@@ -36,10 +35,10 @@ class RefreshTokenGrantHandler(BaseGrantHandler):
                                   {'error': 'access_denied',
                                    'error_description': 'The token has expired'})
 
-        access_token, refresh_token = \
-            token.refresh(request.app,
-                          request.session,
-                          scopes=request.POST.get('scope', '').split())
-        request.session.add(token)
+        access_token, refresh_token = yield from request.db.run(
+            lambda session: token.refresh(request.app,
+                                          session,
+                                          scopes=request.POST.get('scope', '').split()))
+        request.db.session.add(token)
         return JSONResponse(body=token.to_json(access_token=access_token,
                                                refresh_token=refresh_token))
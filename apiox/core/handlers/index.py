@@ -22,17 +22,17 @@ class IndexHandler(BaseHandler):
             },
         }
 
-        with request.app['db-session']() as session:
-            for api in session.query(API).filter_by(advertise=True).all():
-                link = {'title': api.title}
-                if not api.base:
-                    try:
-                        link['href'] = request.app.router[api.id + ':index'].url()
-                    except KeyError:
-                        logger.warning("API %s has no index handler", api.id)
-                        continue
-                else:
-                    link['href'] = '/{}/'.format(api.id)
-                body['_links']['app:' + api.id] = link
+        apis = yield from request.db.run(lambda session: session.query(API).filter_by(advertise=True).all())
+        for api in apis:
+            link = {'title': api.title}
+            if not api.base:
+                try:
+                    link['href'] = request.app.router[api.id + ':index'].url()
+                except KeyError:
+                    logger.warning("API %s has no index handler", api.id)
+                    continue
+            else:
+                link['href'] = '/{}/'.format(api.id)
+            body['_links']['app:' + api.id] = link
         
         return JSONResponse(body=body)
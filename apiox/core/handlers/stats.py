@@ -0,0 +1,27 @@
+import asyncio
+
+from .base import BaseHandler
+from ..response import JSONResponse
+
+
+class StatsHandler(BaseHandler):
+    @asyncio.coroutine
+    def get(self, request):
+        yield from self.require_authentication(request, require_scopes={'/stats'})
+        app = request.app
+        body = {
+            '_links': {
+                'self': {'href': app.router['stats'].url()},
+            },
+            'negotiate': app['negotiate-stats'].to_json(),
+        }
+        # Counters for whichever caches are configured in this worker
+        for name, key in (('ldap', 'async-ldap'),
+                          ('grouperMemberships', 'grouper-memberships'),
+                          ('scopeCache', 'scope-cache'),
+                          ('tokenCache', 'token-cache'),
+                          ('principalCache', 'principal-cache')):
+            stats = getattr(app.get(key), 'stats', None)
+            if stats is not None:
+                body[name] = stats
+        return JSONResponse(body=body)
@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+import json
+
+import aiohttp.web
+from aiohttp.web_exceptions import HTTPBadRequest, HTTPForbidden
+
+from .. import api_id, db
+from ..response import JSONResponse
+from ..schemas import BULK_TOKEN_REQUEST
+from .grant.base import BaseGrantHandler
+
+BULK_GRANT_TYPE = 'bulk_on_behalf_of'
+
+# Tokens are minted and committed this many users at a time, with each batch
+# written out before the next is started.
+BATCH_SIZE = 100
+
+
+class BulkTokenRequestHandler(BaseGrantHandler):
+    """
+    Issues tokens for many users at once to a trusted client, within the scopes
+    its scope grants and scope request grants allow for each user.
+
+    The response is a stream of JSON objects, one per line, each either a
+    token or an error for one user. Each batch of tokens is committed before
+    it's written, so every token received is usable, even if the response is
+    cut short. The final line reports how many were issued and refused.
+    """
+
+    @asyncio.coroutine
+    def post(self, request):
+        yield from self.require_oauth2_client(request, grant_type=BULK_GRANT_TYPE)
+        client = request.token.client
+        if request.token.account != client:
+            raise JSONResponse(base=HTTPForbidden,
+                               body={'error': 'access_denied',
+                                     'error_description': 'Client and account must match'})
+
+        body = yield from self.validated_json(request, api_id, BULK_TOKEN_REQUEST)
+
+        scope_registry = request.app['scope-registry']
+        if not scope_registry.loaded:
+            yield from scope_registry.load(request.app)
+        scopes, invalid_scopes = scope_registry.get_many(request.db.session, body['scopes'])
+        if invalid_scopes:
+            raise JSONResponse(base=HTTPBadRequest,
+                               body={'error': 'invalid_scope',
+                                     'scopes': sorted(invalid_scopes)})
+
+        user_ids = body['userIds']
+        permissible_scopes = yield from client.get_permissible_scopes_for_users(request.app,
+                                                                                request.db,
+                                                                                user_ids,
+                                                                                only_implicit=False)
+        if client.oauth2_token_lifetime:
+            expires = datetime.datetime.utcnow() + datetime.timedelta(0, client.oauth2_token_lifetime)
+        else:
+            expires = True
+
+        response = aiohttp.web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        response.start(request)
+
+        issued = 0
+        for i in range(0, len(user_ids), BATCH_SIZE):
+            results = yield from request.db.run(self.create_tokens,
+                                                request.app,
+                                                client,
+                                                user_ids[i:i+BATCH_SIZE],
+                                                scopes,
+                                                permissible_scopes,
+                                                expires)
+            yield from request.db.commit()
+            for result in results:
+                issued += 'access_token' in result
+                yield from response.write(json.dumps(result, sort_keys=True).encode() + b'\n')
+
+        yield from response.write(json.dumps({'complete': True,
+                                              'issued': issued,
+                                              'refused': len(user_ids) - issued},
+                                             sort_keys=True).encode() + b'\n')
+        yield from response.write_eof()
+        return response
+
+    def create_tokens(self, session, app, client, user_ids, scopes, permissible_scopes, expires):
+        results = []
+        granted_at = datetime.datetime.utcnow()
+        for user_id in user_ids:
+            disallowed_scopes = scopes - permissible_scopes.get(user_id, set())
+            if disallowed_scopes:
+                results.append({'user_id': user_id,
+                                'error': 'access_denied',
+                                'scopes': sorted(scope.id for scope in disallowed_scopes)})
+                continue
+            token, (access_token, refresh_token) = db.Token.create_access_token(app=app,
+                                                                                session=session,
+                                                                                granted_at=granted_at,
+                                                                                client=client,
+                                                                                account=client,
+                                                                                user_id=user_id,
+                                                                                scopes=scopes,
+                                                                                expires=expires)
+            results.append(dict(token.to_json(access_token=access_token, refresh_token=refresh_token),
+                                user_id=user_id))
+        session.flush()
+        return results
@@ -0,0 +1,43 @@
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateIndex
+
+from .db import Base
+from .partitions import PARTITIONED_TABLES, is_partitioned
+
+# There's no migration framework, so indexes added to the models after a
+# database was created are added here. Partitioned tables get theirs when
+# they're created.
+
+
+def missing_indexes(connection):
+    """
+    Returns the indexes declared on the models that the database doesn't have.
+    Tables the database doesn't have are left to create_models, which creates
+    them with their indexes.
+    """
+    inspector = inspect(connection)
+    skip = PARTITIONED_TABLES if is_partitioned(connection) else ()
+    table_names = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table in skip or table.name not in table_names:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in sorted(table.indexes, key=lambda index: index.name)
+                       if index.name not in existing)
+    return missing
+
+
+def create_missing_indexes(engine):
+    """
+    Creates missing indexes without locking out writes, and returns them.
+    """
+    connection = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        indexes = missing_indexes(connection)
+        for index in indexes:
+            ddl = str(CreateIndex(index).compile(dialect=connection.dialect))
+            connection.execute(ddl.replace('INDEX', 'INDEX CONCURRENTLY IF NOT EXISTS', 1))
+        return indexes
+    finally:
+        connection.close()
@@ -1,12 +1,21 @@
+import asyncio
+import concurrent.futures
 import functools
 import re
 
 import ldap3
+from ldap3.core.exceptions import LDAPException
+
+from .cache import TTLCache, SingleFlight
 
 PRINCIPAL_NAME_RE = re.compile(r'^[A-Za-z0-9\-]+(?:/[A-Za-z0-9\-.]+)?@[A-Z.]+$')
 PERSON_DN_RE = re.compile(r'^oakPrimaryPersonID=(\d+),ou=people,dc=oak,dc=ox,dc=ac,dc=uk$')
 PRINCIPAL_DN_RE = re.compile(r'^krbPrincipalName=([0-9a-zA-Z_/]+)@OX.AC.UK,cn=OX.AC.UK,cn=KerberosRealms,dc=oak,dc=ox,dc=ac,dc=uk$')
 
+# The attributes the gateway itself needs, for when it doesn't want everything
+PERSON_ATTRIBUTES = ('displayName', 'oakPrincipal', 'oakOxfordSSOUsername')
+PRINCIPAL_ATTRIBUTES = ('oakPerson',)
+
 class NoSuchLDAPObject(Exception):
     pass
 
@@ -16,56 +25,349 @@ def _with_ldap_connection(func):
         if not hasattr(self, '_conn'):
             self._conn = self._get_ldap_connection()
         try:
-            return func(self, self._conn, *args, **kwargs)
+            return func(self._conn, *args, **kwargs)
         except Exception: # Try again, once
             self._conn = self._get_ldap_connection()
-            return func(self, self._conn, *args, **kwargs)
+            return func(self._conn, *args, **kwargs)
     return f
 
+
+def _get_ldap_connection(url, user, timeout=None):
+    conn = ldap3.Connection(ldap3.Server(url, connect_timeout=timeout),
+                            auto_bind=ldap3.AUTO_BIND_TLS_BEFORE_BIND,
+                            authentication=ldap3.SASL,
+                            sasl_mechanism='GSSAPI',
+                            sasl_credentials=(True,),
+                            user=user,
+                            receive_timeout=timeout)
+    return conn
+
+
+def _get_person(conn, person_id, attributes=ldap3.ALL_ATTRIBUTES):
+    try:
+        conn.search("oakPrimaryPersonID={:d},ou=people,dc=oak,dc=ox,dc=ac,dc=uk".format(person_id),
+                    search_filter='(objectClass=*)',
+                    search_scope=ldap3.BASE,
+                    attributes=attributes)
+        return conn.response[0]['attributes']
+    except (IndexError):
+        raise NoSuchLDAPObject
+
+
+def _get_principal(conn, name, attributes=ldap3.ALL_ATTRIBUTES):
+    if not PRINCIPAL_NAME_RE.match(name):
+        raise ValueError("Not a valid principal name: {!r}".format(name))
+    try:
+        local, realm = name.split('@')
+        conn.search("krbPrincipalName={local}@{realm},cn={realm:s},cn=KerberosRealms,dc=oak,dc=ox,dc=ac,dc=uk".format(local=local,
+                                                                                                                          realm=realm),
+                    search_filter='(objectClass=*)',
+                    search_scope=ldap3.BASE,
+                    attributes=attributes)
+        return conn.response[0]['attributes']
+    except (IndexError):
+        raise NoSuchLDAPObject
+
+
+# Batched lookups search for several objects at once with an OR filter, and
+# return a dict with None for each object that wasn't found.
+BATCH_SIZE = 100
+
+
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def _search_entries(conn, search_base, search_filter, attributes):
+    conn.search(search_base,
+                search_filter=search_filter,
+                search_scope=ldap3.SUBTREE,
+                attributes=attributes)
+    return [entry for entry in conn.response if entry.get('type') == 'searchResEntry']
+
+
+def _get_people(conn, person_ids, attributes=ldap3.ALL_ATTRIBUTES):
+    results = dict.fromkeys(person_ids)
+    for chunk in _chunks(results, BATCH_SIZE):
+        search_filter = '(|{})'.format(''.join('(oakPrimaryPersonID={:d})'.format(person_id)
+                                               for person_id in chunk))
+        for entry in _search_entries(conn, 'ou=people,dc=oak,dc=ox,dc=ac,dc=uk', search_filter, attributes):
+            person_id = parse_person_dn(entry['dn'])
+            if person_id in results:
+                results[person_id] = entry['attributes']
+    return results
+
+
+def _get_principals(conn, names, attributes=ldap3.ALL_ATTRIBUTES):
+    results = dict.fromkeys(names)
+    for chunk in _chunks(filter(PRINCIPAL_NAME_RE.match, results), BATCH_SIZE):
+        search_filter = '(|{})'.format(''.join('(krbPrincipalName={})'.format(escape(name))
+                                               for name in chunk))
+        for entry in _search_entries(conn, 'cn=KerberosRealms,dc=oak,dc=ox,dc=ac,dc=uk', search_filter, attributes):
+            name = entry['dn'].split(',', 1)[0].split('=', 1)[1]
+            if name in results:
+                results[name] = entry['attributes']
+    return results
+
+
+def _get_principal_and_person(conn, name, attributes=ldap3.ALL_ATTRIBUTES):
+    # The person is found by their oakPrincipal pointing back at the principal,
+    # so that both come back from the same search.
+    if not PRINCIPAL_NAME_RE.match(name):
+        raise ValueError("Not a valid principal name: {!r}".format(name))
+    local, realm = name.split('@')
+    principal_dn = "krbPrincipalName={local}@{realm},cn={realm:s},cn=KerberosRealms,dc=oak,dc=ox,dc=ac,dc=uk".format(local=local,
+                                                                                                                       realm=realm)
+    search_filter = '(|(krbPrincipalName={})(oakPrincipal={}))'.format(escape(name), escape(principal_dn))
+    principal = person = None
+    for entry in _search_entries(conn, 'dc=oak,dc=ox,dc=ac,dc=uk', search_filter, attributes):
+        if entry['dn'].lower() == principal_dn.lower():
+            principal = entry['attributes']
+        elif PERSON_DN_RE.match(entry['dn']):
+            person = entry['attributes']
+    if principal is None:
+        raise NoSuchLDAPObject
+    if person is None and 'oakPerson' in principal:
+        try:
+            person = _get_person(conn, parse_person_dn(principal['oakPerson'][0]), attributes)
+        except NoSuchLDAPObject:
+            pass
+    return principal, person
+
+
+def _search(conn, **kwargs):
+    conn.search(**kwargs)
+    return conn.response
+
+
+def _is_healthy(conn):
+    if conn.closed or not conn.bound:
+        return False
+    try:
+        return conn.search('', search_filter='(objectClass=*)', search_scope=ldap3.BASE, attributes=[])
+    except LDAPException:
+        return False
+
+
 class LDAP(object):
     def __init__(self, url, user):
         self.url, self.user = url, user
 
     def _get_ldap_connection(self):
-        conn = ldap3.Connection(self.url,
-                                auto_bind=ldap3.AUTO_BIND_TLS_BEFORE_BIND,
-                                authentication=ldap3.SASL,
-                                sasl_mechanism='GSSAPI',
-                                sasl_credentials=(True,),
-                                user=self.user)
-        return conn
-
-    @_with_ldap_connection
-    def get_person(self, conn, person_id):
+        return _get_ldap_connection(self.url, self.user)
+
+    get_person = _with_ldap_connection(_get_person)
+    get_principal = _with_ldap_connection(_get_principal)
+    get_people = _with_ldap_connection(_get_people)
+    get_principals = _with_ldap_connection(_get_principals)
+    get_principal_and_person = _with_ldap_connection(_get_principal_and_person)
+    search = _with_ldap_connection(_search)
+
+
+class AsyncLDAP(object):
+    """
+    An LDAP client with the same lookups as LDAP, but whose methods are
+    coroutines. create_app() keeps the LDAP client given to it as
+    app['ldap'], for synchronous callers, and puts one of these in
+    app['async-ldap'].
+
+    Operations are run on a bounded pool of connections, each on its own
+    thread. Connecting and waiting for a response each time out after
+    `timeout` seconds at the socket, so a pool slot is only freed once its
+    thread has finished with the connection, even if the caller has been
+    cancelled. A connection that has been
+    idle for more than `health_check_interval` seconds is checked before it's
+    reused, and replaced if it's no longer working.
+    """
+
+    def __init__(self, url, user, *, pool_size=4, timeout=10, health_check_interval=60, loop=None):
+        self.url, self.user = url, user
+        self.pool_size, self.timeout, self.health_check_interval = pool_size, timeout, health_check_interval
+        self._loop = loop or asyncio.get_event_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=pool_size)
+        self._semaphore = asyncio.Semaphore(pool_size, loop=self._loop)
+        self._idle = []
+
+    @asyncio.coroutine
+    def _checkout(self):
+        yield from self._semaphore.acquire()
+        if not self._idle:
+            return None, False
+        conn, last_used = self._idle.pop()
+        return conn, self._loop.time() - last_used >= self.health_check_interval
+
+    def _use(self, held, stale, func, *args, **kwargs):
+        # Runs on the executor thread, which keeps the connection it ends up
+        # with in held[0]
+        if held[0] is not None and stale and not _is_healthy(held[0]):
+            self._discard(held[0])
+            held[0] = None
+        if held[0] is None:
+            held[0] = _get_ldap_connection(self.url, self.user, self.timeout)
+        return func(held[0], *args, **kwargs)
+
+    def _checkin(self, held, future):
+        # Only called once the thread is done with the connection, so it's
+        # never reused or unbound while still in use
+        conn = held[0]
+        if conn is not None:
+            if not future.cancelled() and isinstance(future.exception(), (type(None), NoSuchLDAPObject, ValueError)):
+                self._idle.append((conn, self._loop.time()))
+            else:
+                self._discard(conn)
+        self._semaphore.release()
+
+    def _discard(self, conn):
+        # Don't wait around for a connection that may well be stuck
+        self._executor.submit(conn.unbind)
+
+    @asyncio.coroutine
+    def _call(self, func, *args, retry=True, **kwargs):
+        conn, stale = yield from self._checkout()
+        held = [conn]
+        future = self._loop.run_in_executor(self._executor,
+                                            functools.partial(self._use, held, stale, func, *args, **kwargs))
+        future.add_done_callback(functools.partial(self._checkin, held))
         try:
-            conn.search("oakPrimaryPersonID={:d},ou=people,dc=oak,dc=ox,dc=ac,dc=uk".format(person_id),
-                        search_filter='(objectClass=*)',
-                        search_scope=ldap3.BASE,
-                        attributes=ldap3.ALL_ATTRIBUTES)
-            return conn.response[0]['attributes']
-        except (IndexError):
+            # If we're cancelled, the connection and its slot are handed back
+            # by _checkin() once the thread has finished
+            return (yield from asyncio.shield(future, loop=self._loop))
+        except LDAPException:
+            if not retry:
+                raise
+            # Try again, once, on a fresh connection
+            return (yield from self._call(func, *args, retry=False, **kwargs))
+
+    @asyncio.coroutine
+    def get_person(self, person_id, attributes=ldap3.ALL_ATTRIBUTES):
+        return (yield from self._call(_get_person, person_id, attributes))
+
+    @asyncio.coroutine
+    def get_principal(self, name, attributes=ldap3.ALL_ATTRIBUTES):
+        return (yield from self._call(_get_principal, name, attributes))
+
+    @asyncio.coroutine
+    def get_people(self, person_ids, attributes=ldap3.ALL_ATTRIBUTES):
+        return (yield from self._call(_get_people, person_ids, attributes))
+
+    @asyncio.coroutine
+    def get_principals(self, names, attributes=ldap3.ALL_ATTRIBUTES):
+        return (yield from self._call(_get_principals, names, attributes))
+
+    @asyncio.coroutine
+    def get_principal_and_person(self, name, attributes=ldap3.ALL_ATTRIBUTES):
+        return (yield from self._call(_get_principal_and_person, name, attributes))
+
+    @asyncio.coroutine
+    def search(self, **kwargs):
+        return (yield from self._call(_search, **kwargs))
+
+    def close(self):
+        while self._idle:
+            self._discard(self._idle.pop()[0])
+        self._executor.shutdown(wait=False)
+
+
+class CachingLDAP(object):
+    """
+    Caches the results of get_person and get_principal (and their batched
+    counterparts) from another LDAP client, including lookups for objects
+    that don't exist.
+
+    Concurrent lookups for the same object share a single search. Searches
+    made with search() aren't cached.
+    """
+
+    _missing = object()
+
+    def __init__(self, ldap, *, ttl=300, negative_ttl=60, max_size=10000, loop=None):
+        self.ldap, self.negative_ttl = ldap, negative_ttl
+        self._caches = {'person': TTLCache(max_size=max_size, ttl=ttl),
+                        'principal': TTLCache(max_size=max_size, ttl=ttl)}
+        self._single_flight = SingleFlight(loop=loop)
+        self.negative_hits = 0
+
+    @asyncio.coroutine
+    def _get(self, kind, func, key, attributes):
+        if not isinstance(attributes, str):
+            attributes = tuple(attributes)
+        cache, key = self._caches[kind], (key, attributes)
+        result = cache.get(key)
+        if result is None:
+            result = yield from self._single_flight.do((kind,) + key, self._fetch, cache, func, key)
+        if result is self._missing:
+            self.negative_hits += 1
             raise NoSuchLDAPObject
+        return result
 
-    @_with_ldap_connection
-    def get_principal(self, conn, name):
-        if not PRINCIPAL_NAME_RE.match(name):
-            raise ValueError("Not a valid principal name: {!r}".format(name))
+    @asyncio.coroutine
+    def _fetch(self, cache, func, key):
         try:
-            local, realm = name.split('@')
-            conn.search("krbPrincipalName={local}@{realm},cn={realm:s},cn=KerberosRealms,dc=oak,dc=ox,dc=ac,dc=uk".format(local=local,
-                                                                                                                              realm=realm),
-                        search_filter='(objectClass=*)',
-                        search_scope=ldap3.BASE,
-                        attributes=ldap3.ALL_ATTRIBUTES)
-            #import pdb;pdb.set_trace()
-            return conn.response[0]['attributes']
-        except (IndexError):
-            raise NoSuchLDAPObject
+            result = yield from func(*key)
+        except NoSuchLDAPObject:
+            cache.set(key, self._missing, ttl=self.negative_ttl)
+            return self._missing
+        cache.set(key, result)
+        return result
+
+    @asyncio.coroutine
+    def get_person(self, person_id, attributes=ldap3.ALL_ATTRIBUTES):
+        return (yield from self._get('person', self.ldap.get_person, person_id, attributes))
+
+    @asyncio.coroutine
+    def get_principal(self, name, attributes=ldap3.ALL_ATTRIBUTES):
+        return (yield from self._get('principal', self.ldap.get_principal, name, attributes))
+
+    @asyncio.coroutine
+    def _get_many(self, kind, func, keys, attributes):
+        if not isinstance(attributes, str):
+            attributes = tuple(attributes)
+        cache, results, missing = self._caches[kind], {}, []
+        for key in keys:
+            result = cache.get((key, attributes))
+            if result is None:
+                missing.append(key)
+            else:
+                results[key] = None if result is self._missing else result
+        if missing:
+            for key, result in (yield from func(missing, attributes)).items():
+                if result is None:
+                    cache.set((key, attributes), self._missing, ttl=self.negative_ttl)
+                else:
+                    cache.set((key, attributes), result)
+                results[key] = result
+        return results
+
+    @asyncio.coroutine
+    def get_people(self, person_ids, attributes=ldap3.ALL_ATTRIBUTES):
+        return (yield from self._get_many('person', self.ldap.get_people, person_ids, attributes))
+
+    @asyncio.coroutine
+    def get_principals(self, names, attributes=ldap3.ALL_ATTRIBUTES):
+        return (yield from self._get_many('principal', self.ldap.get_principals, names, attributes))
+
+    @asyncio.coroutine
+    def get_principal_and_person(self, name, attributes=ldap3.ALL_ATTRIBUTES):
+        return (yield from self.ldap.get_principal_and_person(name, attributes))
+
+    @asyncio.coroutine
+    def search(self, **kwargs):
+        return (yield from self.ldap.search(**kwargs))
+
+    @property
+    def stats(self):
+        stats = {kind: cache.stats for kind, cache in self._caches.items()}
+        stats.update({'negativeHits': self.negative_hits,
+                      'coalesced': self._single_flight.coalesced})
+        return stats
+
+    def close(self):
+        for cache in self._caches.values():
+            cache.clear()
+        self.ldap.close()
 
-    @_with_ldap_connection
-    def search(self, conn, **kwargs):
-        conn.search(**kwargs)
-        return conn.response
 
 def parse_person_dn(dn):
     return int(PERSON_DN_RE.match(dn).group(1))
@@ -75,5 +377,5 @@ def parse_principal_dn(dn):
 
 _escape_characters = frozenset('*\\()\0')
 def escape(s):
-    return ''.join(r'\{:X}'.format(c) if c in _escape_characters else c
+    return ''.join(r'\{:02X}'.format(ord(c)) if c in _escape_characters else c
                    for c in s)
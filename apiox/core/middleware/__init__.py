@@ -1,6 +1,6 @@
 # Authentication
 from .basic import basic_auth_middleware
-from .negotiate import negotiate_auth_middleware, add_negotiate_token
+from .negotiate import negotiate_auth_middleware, add_negotiate_token, add_negotiate_session_cookie
 from .oauth2 import oauth2_middleware, persist_bearer_token_query_param
 from .remote_user import remote_user_middleware_factory, persist_remote_user_query_param
 
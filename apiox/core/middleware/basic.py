@@ -21,9 +21,13 @@ def basic_auth_middleware(app, handler):
         if request.headers.get('Authorization', '').startswith('Basic '):
             try:
                 username, password = base64.b64decode(request.headers['Authorization'][6:]).decode('utf-8').split(':', 1)
-                principal = Principal.lookup(app, request.session, id=username)
+                # Not from the principal caches, so a deleted or changed
+                # secret stops working straight away
+                principal = yield from request.db.run(
+                    lambda session: session.query(Principal).filter_by(id=username).first())
                 if principal and principal.is_secret_valid(app, password):
-                    request.token = principal.get_token_as_self(request.session)
+                    request.token = yield from request.db.run(principal.get_token_as_self,
+                                                    app['scope-cache'], app.get('scope-registry'))
             except (ValueError, IndexError):
                 raise HTTPUnauthorized(headers={'WWW-Authenticate': authentication_scheme})
         return (yield from handler(request))
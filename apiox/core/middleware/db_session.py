@@ -1,11 +1,24 @@
 import asyncio
 
+from ..db import LazySession
+
 
 @asyncio.coroutine
 def db_session(app, handler):
     @asyncio.coroutine
     def middleware(request):
-        with app['db-session']() as session:
-            request.session = session
-            return (yield from handler(request))
-    return middleware
\ No newline at end of file
+        # Mirrors app['db-session'], but with the blocking parts run off the
+        # event loop. Nothing is checked out of the connection pool unless the
+        # request actually uses the session.
+        db = app['db-async-session']()
+        request.db, request.session = db, LazySession(db)
+        try:
+            response = yield from handler(request)
+            yield from db.commit()
+            return response
+        except:
+            yield from db.rollback()
+            raise
+        finally:
+            yield from db.close()
+    return middleware
@@ -5,7 +5,52 @@ import socket
 
 from aiohttp.web_exceptions import HTTPUnauthorized
 
-from ..db import Principal
+from ..db import Principal, EphemeralToken
+from ..db.scope import Scope
+from ..db.snapshot import column_values, decode_values, detached, encode_values
+from ..signing import Signer
+
+NEGOTIATE_SESSION_COOKIE = 'apiox-negotiate-session'
+
+
+@asyncio.coroutine
+def get_server_credentials(app, address):
+    # Reverse DNS and acquiring credentials can both block, so they're done
+    # once per listening address on the negotiate thread pool.
+    credentials = app['negotiate-credentials']
+    if address not in credentials:
+        def acquire():
+            host = socket.gethostbyaddr(address)[0]
+            service_name = gssapi.Name('HTTP/{}'.format(host))
+            return gssapi.Credentials(name=service_name, usage='accept')
+        credentials[address] = yield from app.loop.run_in_executor(app['negotiate-executor'], acquire)
+    return credentials[address]
+
+
+# After a successful handshake clients can be given a short-lived signed
+# cookie, which carries snapshots of the principal and their scopes, enough to
+# authenticate later requests without GSSAPI or the database. The cookie is
+# readable by the client, so the principal's secret hash is left out.
+
+def get_negotiate_session_data(token):
+    return {'principal': encode_values((key, value) for key, value in column_values(token.account)
+                                       if key != 'secret_hash'),
+            'scopes': [encode_values(column_values(scope))
+                       for scope in sorted(token.scopes, key=lambda scope: scope.id)]}
+
+
+def get_token_from_negotiate_session(session, data):
+    values = decode_values(Principal, data['principal']) + (('secret_hash', None),)
+    principal = session.merge(detached(Principal, values), load=False)
+    scopes = [session.merge(detached(Scope, decode_values(Scope, scope)), load=False)
+              for scope in data['scopes']]
+    return EphemeralToken(client_id=principal.id,
+                          client=principal,
+                          account_id=principal.id,
+                          account=principal,
+                          user_id=principal.user_id,
+                          scopes=scopes)
+
 
 @asyncio.coroutine
 def negotiate_auth_middleware(app, handler):
@@ -20,26 +65,42 @@ def negotiate_auth_middleware(app, handler):
             return (yield from handler(request))
         authorization = request.headers.get('Authorization', '')
         if authorization.startswith('Negotiate '):
-            host = socket.gethostbyaddr(request.transport.get_extra_info('socket').getsockname()[0])[0]
-            service_name = 'HTTP/{}'.format(host)
-            service_name = gssapi.Name(service_name)
+            address = request.transport.get_extra_info('socket').getsockname()[0]
 
             # The browser is authenticating using GSSAPI, trim off 'Negotiate ' and decode:
             in_token = base64.b64decode(authorization[10:])
 
-            server_creds = gssapi.Credentials(name=service_name, usage='accept')
-            ctx = gssapi.SecurityContext(creds=server_creds)
-
             # Feed the input token to the context, and get an output token in return
-            out_token = ctx.step(in_token)
-            if out_token:
-                request.negotiate_token = base64.b64encode(out_token).decode()
-            if ctx.complete:
-                name = str(ctx.initiator_name)
-                request.token = Principal.lookup(app, request.session, name=name).get_token_as_self(request.session)
+            def step():
+                ctx = gssapi.SecurityContext(creds=server_creds)
+                return ctx, ctx.step(in_token)
+
+            # Handshakes that don't complete are counted as errors
+            with app['negotiate-stats'].timer():
+                server_creds = yield from get_server_credentials(app, address)
+                ctx, out_token = yield from app.loop.run_in_executor(app['negotiate-executor'], step)
+                if out_token:
+                    request.negotiate_token = base64.b64encode(out_token).decode()
+                if not ctx.complete:
+                    raise HTTPUnauthorized
+
+            name = str(ctx.initiator_name)
+            principal = yield from Principal.lookup(app, request.db, name=name)
+            request.token = yield from request.db.run(principal.get_token_as_self,
+                                                      app['scope-cache'], app.get('scope-registry'))
+            if app['negotiate-session-signer']:
+                request.negotiate_session = app['negotiate-session-signer'].sign(
+                    get_negotiate_session_data(request.token),
+                    app['negotiate-session-lifetime'])
+        elif not authorization and app['negotiate-session-signer'] \
+                and NEGOTIATE_SESSION_COOKIE in request.cookies:
+            try:
+                data = app['negotiate-session-signer'].verify(request.cookies[NEGOTIATE_SESSION_COOKIE])
+            except Signer.Invalid:
+                pass
             else:
-                raise HTTPUnauthorized
-                    
+                request.token = get_token_from_negotiate_session(request.db.session, data)
+
         return (yield from handler(request))
     return middleware
 
@@ -48,3 +109,11 @@ def add_negotiate_token(request, response):
     if hasattr(request, 'negotiate_token'):
         response.headers['WWW-Authenticate'] = 'Negotiate {}'.format(request.negotiate_token)
 
+@asyncio.coroutine
+def add_negotiate_session_cookie(request, response):
+    if hasattr(request, 'negotiate_session'):
+        response.set_cookie(NEGOTIATE_SESSION_COOKIE, request.negotiate_session,
+                            max_age=request.app['negotiate-session-lifetime'],
+                            httponly=True,
+                            secure=(request.scheme=='https'))
+
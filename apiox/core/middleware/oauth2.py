@@ -5,9 +5,8 @@ from urllib.parse import urlparse, parse_qs, urlencode
 
 from aiohttp.web_exceptions import HTTPUnauthorized
 
-from ..db import Token
+from ..db import Principal, Token
 from ..response import JSONResponse
-from ..token import hash_token
 
 
 @asyncio.coroutine
@@ -30,9 +29,23 @@ def oauth2_middleware(app, handler):
             bearer_token = None
         if bearer_token:
             try:
-                request.token = Token.authenticate(app=request.app,
-                                                   session=request.session,
-                                                   access_token=bearer_token)
+                if app['access-token-signer'] is not None and Token.is_signed(bearer_token):
+                    token = yield from authenticate_signed(app, request, bearer_token)
+                else:
+                    token = Token.authenticate_cached(app=request.app,
+                                                      session=request.db.session,
+                                                      access_token=bearer_token)
+                    if token is None:
+                        token = yield from Token.authenticate_shared(app=request.app,
+                                                                     session=request.db.session,
+                                                                     access_token=bearer_token)
+                    if token is None:
+                        token = yield from request.db.run(
+                            lambda session: Token.authenticate(app=request.app,
+                                                               session=session,
+                                                               access_token=bearer_token))
+                        yield from token.share(request.app)
+                request.token = token
             except Token.Error as e:
                 authenticate_header = authentication_scheme \
                     + ', error="invalid_token", error_description="{}"'.format(e.description)
@@ -44,6 +57,29 @@ def oauth2_middleware(app, handler):
     return middleware
 
 
+@asyncio.coroutine
+def authenticate_signed(app, request, access_token):
+    if not app['token-revocations'].loaded:
+        yield from app['token-revocations'].load(app)
+    if not app['scope-registry'].loaded:
+        yield from app['scope-registry'].load(app)
+    claims = Token.verify_signed(app, access_token)
+    for principal_id in {claims['client'], claims['account']}:
+        yield from Principal.get_shared(app, request.db.session, principal_id)
+    token = Token.authenticate_signed(app=app,
+                                      session=request.db.session,
+                                      claims=claims)
+    if token is None:
+        token = yield from request.db.run(
+            lambda session: Token.authenticate_signed(app=app,
+                                                      session=session,
+                                                      claims=claims,
+                                                      load_principals=True))
+        yield from token.client.share(app)
+        yield from token.account.share(app)
+    return token
+
+
 @asyncio.coroutine
 def persist_bearer_token_query_param(request, response):
     if 'bearer_token' in request.GET and 'Location' in response.headers:
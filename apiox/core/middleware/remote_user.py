@@ -13,13 +13,15 @@ def remote_user_middleware_factory(use_header=False, use_param=False,
             remote_addr = ipaddress.ip_address(request.transport.get_extra_info('peername')[0])
             if accept_from(remote_addr):
                 if use_header and 'X-Remote-User' in request.headers:
-                    principal = Principal.lookup(app, request.session, name=request.headers['X-Remote-User'])
+                    principal = yield from Principal.lookup(app, request.db, name=request.headers['X-Remote-User'])
                     if principal:
-                        request.token = principal.get_token_as_self(request.session)
+                        request.token = yield from request.db.run(principal.get_token_as_self,
+                                                    app['scope-cache'], app.get('scope-registry'))
                 if use_param and 'remote_user' in request.GET:
-                    principal = Principal.lookup(app, request.session, name=request.GET['remote_user'])
+                    principal = yield from Principal.lookup(app, request.db, name=request.GET['remote_user'])
                     if principal:
-                        request.token = principal.get_token_as_self(request.session)
+                        request.token = yield from request.db.run(principal.get_token_as_self,
+                                                    app['scope-cache'], app.get('scope-registry'))
             return (yield from handler(request))
         return middleware
     return remote_user_middleware
@@ -0,0 +1,173 @@
+import datetime
+
+from sqlalchemy import text
+from sqlalchemy.schema import CreateColumn
+
+from .db import Base
+from .db.token import Token, token_scope
+
+# An optional layout (PostgreSQL 13 or later) in which `token` and
+# `token_scope` are partitioned by the token's expire_at, so that expired
+# tokens can be removed by dropping whole partitions.
+#
+# Refreshable tokens usually have no expiry, and are most of the rows. They
+# can't be dropped by date, so each table is first split on whether there's an
+# expiry. Tokens without one are kept in `token_unexpiring`, and the purger
+# deletes them row by row once they can no longer be used or refreshed. Tokens
+# with one are partitioned by month in `token_expiring`, with a default
+# partition for those that expire beyond the months created so far. Keeping
+# that default small means attaching a new month doesn't have to scan the
+# bulk of the table.
+#
+# Partitioned tables can't have primary keys or unique constraints that don't
+# include the partition key, so `token` only has plain indexes, and nothing
+# has a foreign key to it.
+#
+# `token_scope` rows need a copy of their token's expire_at to be partitioned
+# on, which the ORM doesn't supply. A row's partition is chosen before any
+# BEFORE trigger on a partitioned table runs, so the rows live in
+# `token_scope_data`, and `token_scope` is a view of them. Deletes go through
+# the view directly. An INSTEAD OF trigger handles inserts, and looks up the
+# expiry before inserting into `token_scope_data`.
+
+PARTITIONED_TABLES = (Token.__table__, token_scope)
+
+_PARTITION_SUFFIX_FORMAT = 'p%Y_%m'
+
+
+def _month_start(date):
+    return datetime.datetime(date.year, date.month, 1)
+
+
+def _next_month(date):
+    return _month_start(date + datetime.timedelta(days=32))
+
+
+def _columns(connection, table):
+    return ',\n    '.join(str(CreateColumn(column).compile(dialect=connection.dialect))
+                          for column in table.columns)
+
+
+def _create_indexes(connection, table, table_name=None):
+    for index in table.indexes:
+        connection.execute(text("CREATE INDEX {} ON {} ({})".format(
+            index.name, table_name or table.name, ', '.join(column.name for column in index.columns))))
+
+
+def _create_subpartitions(connection, table_name, prefix, key):
+    connection.execute(text(
+        "CREATE TABLE {}_unexpiring PARTITION OF {} FOR VALUES IN (true)".format(prefix, table_name)))
+    connection.execute(text(
+        "CREATE TABLE {}_expiring PARTITION OF {} FOR VALUES IN (false) PARTITION BY RANGE ({})".format(
+            prefix, table_name, key)))
+    connection.execute(text("CREATE TABLE {0}_default PARTITION OF {0}_expiring DEFAULT".format(prefix)))
+
+
+def create_partitioned_tables(connection):
+    Base.metadata.create_all(connection, tables=[table for table in Base.metadata.sorted_tables
+                                                 if table not in PARTITIONED_TABLES])
+    connection.execute(text("""
+        CREATE TABLE token (
+            {columns},
+            FOREIGN KEY (client_id) REFERENCES principal (id),
+            FOREIGN KEY (account_id) REFERENCES principal (id)
+        ) PARTITION BY LIST ((expire_at IS NULL))
+    """.format(columns=_columns(connection, Token.__table__))))
+    # In place of the primary key
+    connection.execute(text("CREATE INDEX ix_token_id ON token (id)"))
+    _create_indexes(connection, Token.__table__)
+    _create_subpartitions(connection, 'token', 'token', 'expire_at')
+
+    connection.execute(text("""
+        CREATE TABLE token_scope_data (
+            {columns},
+            token_expire_at TIMESTAMP WITHOUT TIME ZONE,
+            FOREIGN KEY (scope_id) REFERENCES scope (id)
+        ) PARTITION BY LIST ((token_expire_at IS NULL))
+    """.format(columns=_columns(connection, token_scope))))
+    _create_indexes(connection, token_scope, 'token_scope_data')
+    _create_subpartitions(connection, 'token_scope_data', 'token_scope', 'token_expire_at')
+    connection.execute(text("""
+        CREATE VIEW token_scope AS
+        SELECT {columns} FROM token_scope_data
+    """.format(columns=', '.join(column.name for column in token_scope.columns))))
+    connection.execute(text("""
+        CREATE FUNCTION token_scope_insert() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO token_scope_data ({columns}, token_expire_at)
+            SELECT {values}, (SELECT expire_at FROM token WHERE id = NEW.token_id);
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """.format(columns=', '.join(column.name for column in token_scope.columns),
+               values=', '.join('NEW.' + column.name for column in token_scope.columns))))
+    connection.execute(text("""
+        CREATE TRIGGER token_scope_insert INSTEAD OF INSERT ON token_scope
+        FOR EACH ROW EXECUTE FUNCTION token_scope_insert()
+    """))
+
+
+def is_partitioned(connection):
+    return connection.scalar(text(
+        "SELECT relkind FROM pg_class WHERE relname = 'token' AND pg_table_is_visible(oid)")) == 'p'
+
+
+def _partitions(connection, table_name):
+    # Returns {partition name: upper bound} for the table's monthly partitions
+    partitions = {}
+    prefix = table_name + '_'
+    for name, in connection.execute(text("""
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            WHERE parent.relname = :parent_name AND pg_table_is_visible(parent.oid)
+        """), parent_name=table_name + '_expiring'):
+        try:
+            start = datetime.datetime.strptime(name[len(prefix):], _PARTITION_SUFFIX_FORMAT)
+        except ValueError:
+            continue  # the default partition
+        partitions[name] = _next_month(start)
+    return partitions
+
+
+def _create_partition(connection, table_name, key, start):
+    # Rows in the new partition's range may already be in the default
+    # partition, and have to be moved before it can be attached.
+    name = '{}_{}'.format(table_name, start.strftime(_PARTITION_SUFFIX_FORMAT))
+    params = {'start': start, 'end': _next_month(start)}
+    connection.execute(text("CREATE TABLE {0} (LIKE {1}_expiring INCLUDING DEFAULTS)".format(name, table_name)))
+    connection.execute(text("""
+        WITH moved AS (
+            DELETE FROM {1}_default WHERE {2} >= :start AND {2} < :end RETURNING *
+        ) INSERT INTO {0} SELECT * FROM moved
+    """.format(name, table_name, key)), **params)
+    connection.execute(text(
+        "ALTER TABLE {}_expiring ATTACH PARTITION {} FOR VALUES FROM (:start) TO (:end)".format(table_name, name)),
+        **params)
+    return name
+
+
+def maintain_partitions(connection, *, months_ahead=3, now=None):
+    """
+    Creates partitions for this month and the next `months_ahead`, and drops
+    those whose tokens have all expired. Returns the names of the partitions
+    created and dropped.
+    """
+    now = now or datetime.datetime.utcnow()
+    created, dropped = [], []
+    if not is_partitioned(connection):
+        raise ValueError("The token table isn't partitioned.")
+    for table_name, key in (('token', 'expire_at'), ('token_scope', 'token_expire_at')):
+        partitions = _partitions(connection, table_name)
+        start = _month_start(now)
+        for _ in range(months_ahead + 1):
+            name = '{}_{}'.format(table_name, start.strftime(_PARTITION_SUFFIX_FORMAT))
+            if name not in partitions:
+                created.append(_create_partition(connection, table_name, key, start))
+            start = _next_month(start)
+        for name, end in sorted(partitions.items()):
+            if end <= now:
+                connection.execute(text("ALTER TABLE {}_expiring DETACH PARTITION {}".format(table_name, name)))
+                connection.execute(text("DROP TABLE {}".format(name)))
+                dropped.append(name)
+    return created, dropped
@@ -0,0 +1,169 @@
+import asyncio
+import collections
+import datetime
+import logging
+import time
+
+from sqlalchemy import or_, and_, func, select
+
+from .db import Token, AuthorizationCode, RevokedToken
+from .db.authorization_code import authorization_code_scope
+from .db.token import token_scope
+
+logger = logging.getLogger(__name__)
+
+# Key for the session-level advisory lock taken for each pass, so that only one
+# of the processes sharing a database purges it at a time. Arbitrary, but has
+# to be the same everywhere.
+PURGE_LOCK_KEY = 0x6170696f78
+
+# Each purge deletes up to a batch of rows in its own transaction, and returns
+# how many it deleted.
+
+
+def _delete_tokens(session, query, batch_size):
+    token_ids = [token_id for token_id, in query.limit(batch_size)]
+    if token_ids:
+        session.execute(token_scope.delete().where(token_scope.c.token_id.in_(token_ids)))
+        session.execute(Token.__table__.update()
+                        .where(Token.parent_id.in_(token_ids))
+                        .values(parent_id=None))
+        return session.execute(Token.__table__.delete().where(Token.id.in_(token_ids))).rowcount
+    return 0
+
+
+def purge_tokens(session, now, batch_size):
+    return _delete_tokens(session, session.query(Token.id).filter(or_(
+        Token.expire_at < now,
+        # Can't be used or refreshed any more
+        and_(Token.refresh_token_hash == None, Token.refresh_at < now),
+    )), batch_size)
+
+
+def purge_unexpiring_tokens(session, now, batch_size):
+    # When tokens are partitioned by expiry, expired ones go when their
+    # partitions are dropped, leaving only those that never expire.
+    return _delete_tokens(session, session.query(Token.id).filter(
+        Token.expire_at == None, Token.refresh_token_hash == None, Token.refresh_at < now,
+    ), batch_size)
+
+
+def purge_authorization_codes(session, now, batch_size):
+    code_ids = [code_id for code_id, in session.query(AuthorizationCode.id)
+                    .filter(AuthorizationCode.expire_at < now)
+                    .limit(batch_size)]
+    if code_ids:
+        session.execute(authorization_code_scope.delete()
+                        .where(authorization_code_scope.c.authorization_code_id.in_(code_ids)))
+        return session.execute(AuthorizationCode.__table__.delete()
+                               .where(AuthorizationCode.id.in_(code_ids))).rowcount
+    return 0
+
+
+def purge_revoked_tokens(session, now, batch_size):
+    token_ids = [token_id for token_id, in session.query(RevokedToken.token_id)
+                     .filter(RevokedToken.expire_at < now)
+                     .limit(batch_size)]
+    if token_ids:
+        return session.execute(RevokedToken.__table__.delete()
+                               .where(RevokedToken.token_id.in_(token_ids))).rowcount
+    return 0
+
+
+PURGES = collections.OrderedDict([
+    ('tokens', purge_tokens),
+    ('authorizationCodes', purge_authorization_codes),
+    ('revokedTokens', purge_revoked_tokens),
+])
+
+PARTITIONED_PURGES = collections.OrderedDict(PURGES, tokens=purge_unexpiring_tokens)
+
+
+class Purger(object):
+    """
+    Deletes expired tokens, authorization codes and revocation records, a
+    batch at a time, pausing between batches so as not to load the database.
+
+    Every worker runs one, but each pass holds an advisory lock, and is
+    skipped if another process already has it.
+    """
+
+    def __init__(self, *, batch_size=1000, batch_delay=0.1, interval=300, purges=PURGES):
+        self.batch_size, self.batch_delay, self.interval = batch_size, batch_delay, interval
+        self.purges = purges
+
+    def _purge_batch(self, app, purge, now):
+        with app['db-session']() as session:
+            return purge(session, now, self.batch_size)
+
+    def _lock(self, app):
+        # Returns the connection holding the lock, or None if it's taken
+        connection = app['db'].connect()
+        try:
+            if connection.scalar(select([func.pg_try_advisory_lock(PURGE_LOCK_KEY)])):
+                return connection
+        except:
+            connection.close()
+            raise
+        connection.close()
+        return None
+
+    def _unlock(self, connection):
+        try:
+            connection.execute(select([func.pg_advisory_unlock(PURGE_LOCK_KEY)]))
+        finally:
+            connection.close()
+
+    def run(self, app):
+        """
+        Purges everything that had expired when it was called, and returns
+        counts of what was deleted, or None if another process is purging.
+        """
+        lock = self._lock(app)
+        if lock is None:
+            return None
+        try:
+            now, counts = datetime.datetime.utcnow(), collections.OrderedDict()
+            for name, purge in self.purges.items():
+                counts[name] = 0
+                while True:
+                    count = self._purge_batch(app, purge, now)
+                    counts[name] += count
+                    if count < self.batch_size:
+                        break
+                    time.sleep(self.batch_delay)
+            return counts
+        finally:
+            self._unlock(lock)
+
+    @asyncio.coroutine
+    def run_async(self, app):
+        lock = yield from app.loop.run_in_executor(app['db-executor'], self._lock, app)
+        if lock is None:
+            return None
+        try:
+            now, counts = datetime.datetime.utcnow(), collections.OrderedDict()
+            for name, purge in self.purges.items():
+                counts[name] = 0
+                while True:
+                    count = yield from app.loop.run_in_executor(app['db-executor'],
+                                                                self._purge_batch, app, purge, now)
+                    counts[name] += count
+                    if count < self.batch_size:
+                        break
+                    yield from asyncio.sleep(self.batch_delay, loop=app.loop)
+            return counts
+        finally:
+            yield from app.loop.run_in_executor(app['db-executor'], self._unlock, lock)
+
+    @asyncio.coroutine
+    def run_periodically(self, app):
+        while True:
+            try:
+                counts = yield from self.run_async(app)
+                if counts and any(counts.values()):
+                    logger.info("Purged expired rows: %s",
+                                ', '.join('{} {}'.format(count, name) for name, count in counts.items()))
+            except Exception:
+                logger.exception("Failed to purge expired rows")
+            yield from asyncio.sleep(self.interval, loop=app.loop)
@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import datetime
+import json
+import statistics
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from .db import Base, Token, AuthorizationCode, Principal, API, AsyncSession
+from .partitions import create_partitioned_tables, maintain_partitions
+from .purge import PURGES, PARTITIONED_PURGES
+from .routing import RoutingTable
+from .token import generate_token
+
+# Seeds a throwaway schema with realistic volumes, runs the queries behind
+# the hot request paths, and checks their plans and latencies. Everything
+# happens in one transaction that's rolled back at the end, so it's safe to
+# point at a database that's in use, though it'll add to its load.
+
+SCHEMA = 'apiox_query_plans'
+
+VOLUMES = collections.OrderedDict([
+    ('apis', 20),
+    ('scopes', 200),
+    ('principals', 20000),
+    ('tokens', 200000),
+    ('authorization_codes', 20000),
+    ('scope_grants', 5000),
+])
+
+# Scanning tables this small is cheaper than using an index
+MIN_SCANNED_ROWS = 1000
+
+# Purges are timed and checked for sequential scans, but they run in the
+# background, so aren't held to the max_ms budget. They're run as of
+# PURGE_AGE before the seeded data's `now`, when a sliver of it had expired,
+# as for a purger that runs every few minutes.
+PURGE_AGE = datetime.timedelta(days=28)
+PURGE_BATCH_SIZE = 1000
+
+_CLIENT = "lpad(((i % :clients) * 10 + 10)::text, 32, '0')"
+_ACCOUNT = "lpad((i % :principals + 1)::text, 32, '0')"
+_SCOPE = "'api' || (k % :apis + 1) || '/scope' || k"
+_SCOPES_FOR = "(VALUES (1), (7), (13)) AS m(m), LATERAL (SELECT (i * m) % :scopes + 1 AS k) AS k"
+
+SEED_STATEMENTS = (
+    """INSERT INTO api (id, title, base, require_scope, require_user, require_auth, require_role,
+                        advertise, available, paths)
+       SELECT 'api' || i, 'API ' || i, 'http://localhost/' || i, '{}', false, true, '{}', true, true, '[]'
+       FROM generate_series(1, :apis) AS i""",
+    """INSERT INTO scope (id, api_id, title, granted_to_user, personal, advertise)
+       SELECT {scope}, 'api' || (k % :apis + 1), 'Scope ' || k, k % 4 = 0, false, true
+       FROM generate_series(1, :scopes) AS k""".format(scope=_SCOPE),
+    """INSERT INTO principal (id, name, user_id, type, redirect_uris, allowed_oauth2_grant_types)
+       SELECT lpad(i::text, 32, '0'), 'principal' || i || '@EXAMPLE.ORG', i,
+              CASE WHEN i % 10 = 0 THEN 'service' ELSE 'user' END, '{}',
+              '{authorization_code,refresh_token,client_credentials}'
+       FROM generate_series(1, :principals) AS i""",
+    """INSERT INTO token (id, access_token_hash, refresh_token_hash, client_id, account_id, user_id,
+                          granted_at, refresh_at, expire_at)
+       SELECT lpad(i::text, 32, 't'), md5('a' || i) || md5('A' || i),
+              CASE WHEN i % 2 = 0 THEN md5('r' || i) || md5('R' || i) END,
+              {client}, {account}, i % :principals + 1,
+              :now - interval '1 day' * (i % 30), :now + interval '10 minutes',
+              CASE WHEN i % 3 != 0 THEN :now + interval '1 day' * (i % 90 - 30) END
+       FROM generate_series(1, :tokens) AS i""".format(client=_CLIENT, account=_ACCOUNT),
+    """INSERT INTO token_scope (scope_id, token_id)
+       SELECT DISTINCT {scope}, lpad(i::text, 32, 't')
+       FROM generate_series(1, :tokens) AS i, {scopes_for}""".format(scope=_SCOPE, scopes_for=_SCOPES_FOR),
+    """INSERT INTO authorization_code (id, code_hash, client_id, account_id, user_id, granted_at, expire_at)
+       SELECT i, md5('c' || i) || md5('C' || i), {client}, {account}, i % :principals + 1,
+              :now, :now + interval '10 minutes'
+       FROM generate_series(1, :authorization_codes) AS i""".format(client=_CLIENT, account=_ACCOUNT),
+    """INSERT INTO authorization_code_scope (authorization_code_id, scope_id)
+       SELECT DISTINCT i, {scope}
+       FROM generate_series(1, :authorization_codes) AS i, {scopes_for}""".format(scope=_SCOPE,
+                                                                                 scopes_for=_SCOPES_FOR),
+    """INSERT INTO scope_grant (id, client_id, target_groups, granted_at)
+       SELECT i, {client}, CASE WHEN i % 2 = 0 THEN ARRAY[md5('g' || i)] END, :now
+       FROM generate_series(1, :scope_grants) AS i""".format(client=_CLIENT),
+    """INSERT INTO scope_grant_scope (scope_grant_id, scope_id)
+       SELECT DISTINCT i, {scope}
+       FROM generate_series(1, :scope_grants) AS i, {scopes_for}""".format(scope=_SCOPE, scopes_for=_SCOPES_FOR),
+    """INSERT INTO scope_request_grant (id, client_id, target_groups, granted_at)
+       SELECT i, {client}, ARRAY[md5('g' || i)], :now
+       FROM generate_series(1, :scope_grants) AS i""".format(client=_CLIENT),
+    """INSERT INTO scope_request_grant_scope (scope_request_grant_id, scope_id)
+       SELECT DISTINCT i, {scope}
+       FROM generate_series(1, :scope_grants) AS i, {scopes_for}""".format(scope=_SCOPE, scopes_for=_SCOPES_FOR),
+)
+
+Probe = collections.namedtuple('Probe', ('access_token', 'refresh_token', 'code',
+                                         'client_id', 'principal_id', 'principal_name', 'api_id', 'now'))
+
+Result = collections.namedtuple('Result', ('name', 'median_ms', 'statements', 'seq_scans', 'failures'))
+
+
+def seed(connection, app, volumes, now):
+    params = dict(volumes, clients=max(volumes['principals'] // 10, 1), now=now)
+    for statement in SEED_STATEMENTS:
+        connection.execute(text(statement), **params)
+
+    # Rows whose secrets we know, chosen from the middle of each table
+    probe = Probe(access_token=generate_token(),
+                  refresh_token=generate_token(),
+                  code=generate_token(),
+                  client_id='{:0>32}'.format(volumes['principals'] // 20 * 10 or 10),
+                  principal_id='{:0>32}'.format(volumes['principals'] // 2 + 1),
+                  principal_name='principal{}'.format(volumes['principals'] // 2 + 1),
+                  api_id='api{}'.format(volumes['apis'] // 2 + 1),
+                  now=now)
+    hasher = app['token-hasher']
+    connection.execute(text("""
+        UPDATE token SET access_token_hash = :access_token_hash, refresh_token_hash = :refresh_token_hash,
+                         refresh_at = :refresh_at, expire_at = :expire_at
+        WHERE id = lpad(CAST(:i AS text), 32, 't')
+    """), access_token_hash=hasher.hash(probe.access_token),
+          refresh_token_hash=hasher.hash(probe.refresh_token),
+          refresh_at=now + datetime.timedelta(minutes=10),
+          expire_at=now + datetime.timedelta(days=30),
+          i=volumes['tokens'] // 2)
+    connection.execute(text("UPDATE authorization_code SET code_hash = :code_hash WHERE id = :i"),
+                       code_hash=hasher.hash(probe.code), i=volumes['authorization_codes'] // 2)
+    # Partitioned tables rather than the token_scope view, when there is one
+    for table_name, in connection.execute(text(
+            "SELECT relname FROM pg_class WHERE relnamespace = CAST(:schema AS regnamespace)"
+            " AND relkind IN ('r', 'p')"), schema=SCHEMA):
+        connection.execute(text('ANALYZE ' + table_name))
+    return probe
+
+
+def authenticate(app, session, probe):
+    Token.authenticate(app=app, session=session, access_token=probe.access_token)
+
+
+def refresh_token_grant(app, session, probe):
+    token = Token.get_by_refresh_token(app, session, probe.refresh_token)
+    # As loaded by Token.refresh()
+    token.client, list(token.scopes)
+
+
+def authorization_code_grant(app, session, probe):
+    code = AuthorizationCode.get_by_code(app, session, probe.code)
+    # As loaded by convert_to_access_token()
+    code.client, code.account, list(code.scopes)
+
+
+def _lookup_principal(session, **kwargs):
+    loop = asyncio.get_event_loop()
+    db = AsyncSession(lambda: session, loop=loop)
+    app = {'default-realm': 'EXAMPLE.ORG'}
+    loop.run_until_complete(Principal.lookup(app, db, **kwargs))
+
+
+def principal_lookup_by_id(app, session, probe):
+    _lookup_principal(session, id=probe.principal_id)
+
+
+def principal_lookup_by_name(app, session, probe):
+    _lookup_principal(session, name=probe.principal_name)
+
+
+def client_scopes(app, session, probe):
+    client = session.query(Principal).get(probe.client_id)
+    client.get_token_as_self(session)
+    client._get_scope_grants(session, False)
+
+
+def api_dispatch(app, session, probe):
+    # Loading routes reads the whole table, by design
+    RoutingTable().snapshot(session)
+    session.query(API).get(probe.api_id)
+
+
+def purge_case(purge):
+    def case(app, session, probe):
+        # Rolled back, so that each run has the same rows to delete
+        transaction = session.begin_nested()
+        try:
+            purge(session, probe.now - PURGE_AGE, PURGE_BATCH_SIZE)
+        finally:
+            transaction.rollback()
+    return case
+
+
+# Case names, with the tables each is expected to scan in full
+CASES = collections.OrderedDict([
+    ('Token.authenticate', (authenticate, ())),
+    ('refresh token grant', (refresh_token_grant, ())),
+    ('authorization code grant', (authorization_code_grant, ())),
+    ('Principal.lookup(id=)', (principal_lookup_by_id, ())),
+    ('Principal.lookup(name=)', (principal_lookup_by_name, ())),
+    ('client scopes', (client_scopes, ())),
+    ('APIDispatchHandler', (api_dispatch, ('api',))),
+])
+
+
+def _seq_scans(plan):
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+    for subplan in plan.get('Plans', ()):
+        yield from _seq_scans(subplan)
+
+
+def explain(connection, statement, parameters):
+    plans = connection.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + statement, parameters).scalar()
+    if isinstance(plans, str):
+        plans = json.loads(plans)
+    return plans[0]
+
+
+def run_case(engine, connection, app, probe, func, full_scans, repeat):
+    session = Session(bind=connection)
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if conn.connection is connection.connection and (statement, parameters) not in statements:
+            statements.append((statement, parameters))
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        func(app, session, probe)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+    timings = []
+    for _ in range(repeat):
+        session.expunge_all()
+        start = time.perf_counter()
+        func(app, session, probe)
+        timings.append((time.perf_counter() - start) * 1000)
+    session.close()
+
+    seq_scans = set()
+    for statement, parameters in statements:
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            seq_scans.update(_seq_scans(explain(connection, statement, parameters)['Plan']))
+    row_counts = dict(connection.execute(text(
+        "SELECT relname, reltuples FROM pg_class WHERE pg_table_is_visible(oid)")).fetchall())
+    seq_scans = {relation for relation in seq_scans
+                 if relation not in full_scans and row_counts.get(relation, 0) >= MIN_SCANNED_ROWS}
+    return statistics.median(timings), [statement for statement, _ in statements], seq_scans
+
+
+def run(app, *, scale=1.0, repeat=20, max_ms=20.0, baseline=None, tolerance=1.5):
+    """
+    Runs each of CASES and each of the purges against a seeded copy of the
+    schema, and returns a Result for each. A case fails if a query scans a
+    large table, if its median time exceeds max_ms (purges excepted), or if
+    it's more than `tolerance` times slower than in `baseline` (a dict of case
+    names to median times).
+    """
+    engine = app['db']
+    volumes = {name: max(int(volume * scale), 1) for name, volume in VOLUMES.items()}
+    now = datetime.datetime.utcnow()
+    results = []
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        connection.execute(text('CREATE SCHEMA ' + SCHEMA))
+        connection.execute(text('SET LOCAL search_path TO ' + SCHEMA))
+        if app.get('token-partitions'):
+            create_partitioned_tables(connection)
+            maintain_partitions(connection, months_ahead=app['token-partitions-ahead'], now=now)
+            purges = PARTITIONED_PURGES
+        else:
+            Base.metadata.create_all(connection)
+            purges = PURGES
+        probe = seed(connection, app, volumes, now)
+
+        cases = [(name, func, full_scans, max_ms) for name, (func, full_scans) in CASES.items()]
+        cases.extend(('purge {}'.format(name), purge_case(purge), (), None)
+                     for name, purge in purges.items())
+
+        # Caches would hide the queries
+        uncached_app = {'token-hasher': app['token-hasher']}
+        for name, func, full_scans, budget_ms in cases:
+            median_ms, statements, seq_scans = run_case(engine, connection, uncached_app, probe,
+                                                        func, full_scans, repeat)
+            failures = ['sequential scan on {}'.format(relation) for relation in sorted(seq_scans)]
+            if budget_ms is not None and median_ms > budget_ms:
+                failures.append('{:.2f}ms is over the {:.2f}ms budget'.format(median_ms, budget_ms))
+            if baseline and name in baseline and median_ms > baseline[name] * tolerance:
+                failures.append('{:.2f}ms is more than {}x the baseline of {:.2f}ms'.format(
+                    median_ms, tolerance, baseline[name]))
+            results.append(Result(name, median_ms, statements, seq_scans, failures))
+    finally:
+        transaction.rollback()
+        connection.close()
+    return results
@@ -0,0 +1,64 @@
+import asyncio
+import datetime
+import logging
+
+from .db.revoked_token import RevokedToken
+
+logger = logging.getLogger(__name__)
+
+
+class RevocationList(object):
+    """
+    An in-memory copy of the `revoked_token` table, consulted when
+    authenticating signed access tokens.
+
+    It's reloaded every `interval` seconds by refresh_periodically(), so
+    revocations made by other processes take effect within that time.
+    Revocations made in this process take effect immediately.
+    """
+
+    def __init__(self, *, interval=30):
+        self.interval = interval
+        self._revoked = None
+
+    @property
+    def loaded(self):
+        return self._revoked is not None
+
+    def add(self, token_id, revoked_at, expire_at):
+        if self._revoked is not None:
+            self._revoked[token_id] = (revoked_at, expire_at)
+
+    def is_revoked(self, token_id, issued_at):
+        try:
+            revoked_at, expire_at = self._revoked[token_id]
+        except KeyError:
+            return False
+        return issued_at <= revoked_at
+
+    def build(self, session):
+        now = datetime.datetime.utcnow()
+        return {revoked.token_id: (revoked.revoked_at, revoked.expire_at)
+                for revoked in session.query(RevokedToken).filter(RevokedToken.expire_at > now)}
+
+    @asyncio.coroutine
+    def load(self, app):
+        def build():
+            with app['db-session']() as session:
+                return self.build(session)
+        revoked = yield from app.loop.run_in_executor(app['db-executor'], build)
+        # Keep anything revoked locally since the query was made
+        now = datetime.datetime.utcnow()
+        for token_id, (revoked_at, expire_at) in (self._revoked or {}).items():
+            if expire_at > now and (token_id not in revoked or revoked[token_id][0] < revoked_at):
+                revoked[token_id] = (revoked_at, expire_at)
+        self._revoked = revoked
+
+    @asyncio.coroutine
+    def refresh_periodically(self, app):
+        while True:
+            try:
+                yield from self.load(app)
+            except Exception:
+                logger.exception("Failed to load token revocation list")
+            yield from asyncio.sleep(self.interval, loop=app.loop)
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import re
+from urllib.parse import urljoin
+
+from .cache import SingleFlight
+from .db import API
+from .db.snapshot import column_values
+
+__all__ = ['Route', 'PathMatcher', 'RoutedAPI', 'RoutingTable', 'literal_prefix']
+
+logger = logging.getLogger(__name__)
+
+
+def _first(*values):
+    for value in values:
+        if value is not None:
+            return value
+
+
+class Route(object):
+    """
+    A single entry in an API's `paths`, with its source pattern compiled and
+    its effective access requirements worked out from the API's defaults.
+    """
+
+    def __init__(self, api, path):
+        self.path = path
+        self.pattern = re.compile(path['sourcePath'])
+        self.base, self.target_path = api.base, path['targetPath']
+
+        self.allow_methods = path.get('allowMethods')
+        self.available = _first(api.available, path.get('available'), True)
+        self.require_auth = _first(path.get('requireAuth'), api.require_auth, False)
+        self.require_user = _first(path.get('requireUser'), api.require_user, False)
+        self.require_role = _first(path.get('requireRole'), api.require_role)
+        self.require_scope = _first(path.get('requireScope'), api.require_scope)
+
+    def get_target_url(self, match):
+        # Captured groups may themselves be relative or absolute URLs, so the
+        # path is filled in before it's resolved against the base.
+        return urljoin(self.base, self.target_path.format(*match.groups(), **match.groupdict()))
+
+
+_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+_QUANTIFIERS = frozenset('*+?{')
+_INLINE_FLAGS_RE = re.compile(r'\(\?[aiLmsux]')
+
+
+def literal_prefix(pattern):
+    """
+    Returns a string that every path matched by pattern must start with.
+    """
+    if '|' in pattern or _INLINE_FLAGS_RE.search(pattern):
+        return ''
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+    for i, c in enumerate(pattern):
+        if c in _METACHARACTERS:
+            # A quantifier applies to the character before it, so that's not
+            # a literal either.
+            if c in _QUANTIFIERS:
+                i -= 1
+            return pattern[:max(i, 0)]
+    return pattern
+
+
+class PathMatcher(object):
+    """
+    Finds the first of a list of routes whose pattern matches a path.
+
+    Routes are indexed in a trie by the literal prefixes of their patterns,
+    so only those whose prefix the path starts with are tried, still in their
+    original order.
+    """
+
+    def __init__(self, routes):
+        self.routes = list(routes)
+        self._trie = {}
+        for i, route in enumerate(self.routes):
+            node = self._trie
+            for c in literal_prefix(route.pattern.pattern):
+                node = node.setdefault(c, {})
+            node.setdefault(None, []).append(i)
+
+    def candidates(self, path):
+        node, indexes = self._trie, []
+        indexes.extend(node.get(None, ()))
+        for c in path:
+            try:
+                node = node[c]
+            except KeyError:
+                break
+            indexes.extend(node.get(None, ()))
+        return sorted(indexes)
+
+    def match(self, path):
+        for i in self.candidates(path):
+            route = self.routes[i]
+            match = route.pattern.match(path)
+            if match:
+                return route, match
+        return None, None
+
+
+class RoutedAPI(object):
+    def __init__(self, api):
+        self.id, self.title, self.base = api.id, api.title, api.base
+        routes = []
+        for path in api.paths or ():
+            try:
+                routes.append(Route(api, path))
+            except re.error:
+                logger.warning("Ignoring invalid sourcePath %r for API %s", path.get('sourcePath'), api.id)
+        self.matcher = PathMatcher(routes)
+
+    @property
+    def routes(self):
+        return self.matcher.routes
+
+    def match(self, path):
+        return self.matcher.match(path)
+
+
+class RoutingTable(object):
+    """
+    An in-memory copy of the dispatch rules in the `api` table.
+
+    The whole table is rebuilt by load(), and swapped in in one go once it's
+    complete, so lookups never see a partially-loaded table.
+    """
+
+    def __init__(self):
+        self._apis = None
+        self._generation = 0
+        self._first_load = SingleFlight()
+
+    @property
+    def loaded(self):
+        return self._apis is not None
+
+    def build(self, snapshots):
+        apis = (API(**dict(values)) for values in snapshots)
+        return {api.id: RoutedAPI(api) for api in apis}
+
+    def snapshot(self, session):
+        return [column_values(api) for api in session.query(API).all()]
+
+    @asyncio.coroutine
+    def load(self, app):
+        def snapshot():
+            with app['db-session']() as session:
+                return self.snapshot(session)
+        self._generation += 1
+        generation = self._generation
+        # Other workers may have already fetched the definitions
+        shared = app.get('shared-cache')
+        snapshots = (yield from shared.get('api', 'all')) if shared is not None else None
+        if snapshots is None:
+            snapshots = yield from app.loop.run_in_executor(app['db-executor'], snapshot)
+            if shared is not None:
+                yield from shared.set('api', 'all', snapshots)
+        apis = yield from app.loop.run_in_executor(app['db-executor'], self.build, snapshots)
+        # Don't clobber the results of a load that started after this one
+        if generation == self._generation:
+            self._apis = apis
+
+    @asyncio.coroutine
+    def ensure_loaded(self, app):
+        # Requests that arrive before the table is loaded share one load
+        if not self.loaded:
+            yield from self._first_load.do(None, self.load, app)
+
+    @asyncio.coroutine
+    def reload_periodically(self, app, interval):
+        while True:
+            yield from asyncio.sleep(interval, loop=app.loop)
+            try:
+                yield from self.load(app)
+            except Exception:
+                logger.exception("Failed to reload API definitions")
+
+    def get(self, api_id):
+        return self._apis.get(api_id)
+
+
+@asyncio.coroutine
+def reload_apis(app):
+    yield from app['api-routes'].load(app)
+    yield from app['scope-registry'].load(app)
+
+
+@asyncio.coroutine
+def apis_changed(app):
+    shared = app.get('shared-cache')
+    if shared is not None:
+        yield from shared.invalidate('api', 'all')
+    yield from reload_apis(app)
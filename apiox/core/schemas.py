@@ -1,5 +1,6 @@
 API = 'api'
 CLIENT = 'client'
+BULK_TOKEN_REQUEST = 'bulk-token-request'
 
 _scope_schema = {
     'properties': {
@@ -94,6 +95,27 @@ _api_schema = {
 }
 
 
+_bulk_token_request_schema = {
+    'type': 'object',
+    'properties': {
+        'userIds': {
+            'type': 'array',
+            'items': {'type': 'integer'},
+            'minItems': 1,
+            'maxItems': 10000,
+            'uniqueItems': True,
+        },
+        'scopes': {
+            'type': 'array',
+            'items': {'type': 'string'},
+            'minItems': 1,
+            'uniqueItems': True,
+        },
+    },
+    'required': ['userIds', 'scopes'],
+}
+
+
 def _get_client_schema(app):
     return {
         'properties': {
@@ -119,4 +141,5 @@ def get_schemas(app):
     return {
         API: _api_schema,
         CLIENT: _get_client_schema(app),
+        BULK_TOKEN_REQUEST: _bulk_token_request_schema,
     }
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+from sqlalchemy.orm import joinedload
+
+from .db.scope import Scope, ScopeAlias
+from .db.snapshot import column_values, detached
+
+__all__ = ['ScopeRegistry']
+
+logger = logging.getLogger(__name__)
+
+
+class ScopeRegistry(object):
+    """
+    An in-memory copy of the `scope` and `scope_alias` tables.
+
+    Scopes only change when APIs are declared or updated, so lookups are
+    answered from here, and the scopes handed back are attached to the
+    caller's session without querying for them.
+    """
+
+    def __init__(self):
+        self._state = None
+        self._generation = 0
+
+    @property
+    def loaded(self):
+        return self._state is not None
+
+    def build(self, session):
+        scopes, aliases = {}, {}
+        for scope in session.query(Scope).options(joinedload(Scope.aliases)):
+            scopes[scope.id] = (column_values(scope),
+                                tuple(column_values(alias) for alias in scope.aliases))
+            for alias in scope.aliases:
+                aliases[alias.id] = scope.id
+        user_scope_ids = frozenset(scope_id for scope_id, (values, _) in scopes.items()
+                                   if dict(values)['granted_to_user'])
+        return scopes, aliases, user_scope_ids
+
+    @asyncio.coroutine
+    def load(self, app):
+        def build():
+            with app['db-session']() as session:
+                return self.build(session)
+        self._generation += 1
+        generation = self._generation
+        state = yield from app.loop.run_in_executor(app['db-executor'], build)
+        if generation == self._generation:
+            self._state = state
+
+    @asyncio.coroutine
+    def reload_periodically(self, app, interval):
+        while True:
+            yield from asyncio.sleep(interval, loop=app.loop)
+            try:
+                yield from self.load(app)
+            except Exception:
+                logger.exception("Failed to reload scopes")
+
+    def resolve(self, scope_id):
+        scopes, aliases, _ = self._state
+        if scope_id in scopes:
+            return scope_id
+        return aliases.get(scope_id)
+
+    def __contains__(self, scope_id):
+        return self.resolve(scope_id) is not None
+
+    def get(self, session, scope_id):
+        scope_id = self.resolve(scope_id)
+        if scope_id is None:
+            return None
+        values, alias_values = self._state[0][scope_id]
+        scope = detached(Scope, values,
+                         aliases=[detached(ScopeAlias, alias) for alias in alias_values])
+        return session.merge(scope, load=False)
+
+    def get_many(self, session, scope_ids):
+        """
+        Returns the set of scopes with the given IDs or aliases, and the set of
+        those IDs that don't name any scope.
+        """
+        scopes, invalid = set(), set()
+        for scope_id in scope_ids:
+            scope = self.get(session, scope_id)
+            if scope is None:
+                invalid.add(scope_id)
+            else:
+                scopes.add(scope)
+        return scopes, invalid
+
+    def user_scopes(self, session):
+        return set(self.get(session, scope_id) for scope_id in self._state[2])
@@ -0,0 +1,265 @@
+import asyncio
+import functools
+import logging
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger('apiox.server')
+
+# Set in the environment of worker processes started by supervise(), to the
+# number of the listening socket's file descriptor
+WORKER_FD_VARIABLE = 'APIOX_WORKER_FD'
+# Also set for workers, to a pipe they write to once they're serving
+READY_FD_VARIABLE = 'APIOX_READY_FD'
+
+
+def _family():
+    if os.environ.get('LISTEN_SOCKET'):
+        return socket.AF_UNIX
+    return socket.AF_INET6 if ':' in os.environ['LISTEN_HOST'] else socket.AF_INET
+
+
+def listening_socket(*, reuse_port=False):
+    """
+    Creates the socket to serve on, from LISTEN_SOCKET (a Unix socket path),
+    or LISTEN_HOST and LISTEN_PORT.
+    """
+    if os.environ.get('LISTEN_SOCKET'):
+        path = os.environ['LISTEN_SOCKET']
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        logger.info("Listening on %s", path)
+    else:
+        host, port = os.environ['LISTEN_HOST'], int(os.environ.get('LISTEN_PORT', 8000))
+        sock = socket.socket(_family(), socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        logger.info("Listening on %s:%d", host, port)
+    sock.listen(int(os.environ.get('LISTEN_BACKLOG', 1024)))
+    sock.setblocking(False)
+    return sock
+
+
+def handler_options():
+    """
+    Keep-alive and timeout settings for app.make_handler(), from KEEP_ALIVE
+    and REQUEST_TIMEOUT, in seconds.
+    """
+    options = {}
+    if 'KEEP_ALIVE' in os.environ:
+        options['keep_alive'] = float(os.environ['KEEP_ALIVE'])
+    if 'REQUEST_TIMEOUT' in os.environ:
+        options['timeout'] = float(os.environ['REQUEST_TIMEOUT'])
+    return options
+
+
+def startup(app, loop):
+    if app.get('shared-cache') is not None:
+        from .shared_cache import handle_invalidation
+        invalidation_task = asyncio.ensure_future(
+            app['shared-cache'].listen(functools.partial(handle_invalidation, app)), loop=loop)
+        app.register_on_finish(lambda app: invalidation_task.cancel())
+    if 'api-routes' in app:
+        loop.run_until_complete(app['api-routes'].load(app))
+        # Changes made by other processes are only announced over the shared cache
+        if app.get('shared-cache') is None and app.get('api-reload-interval'):
+            routes_task = asyncio.ensure_future(
+                app['api-routes'].reload_periodically(app, app['api-reload-interval']), loop=loop)
+            app.register_on_finish(lambda app: routes_task.cancel())
+    if 'scope-registry' in app:
+        loop.run_until_complete(app['scope-registry'].load(app))
+        if app.get('shared-cache') is None and app.get('api-reload-interval'):
+            scopes_task = asyncio.ensure_future(
+                app['scope-registry'].reload_periodically(app, app['api-reload-interval']), loop=loop)
+            app.register_on_finish(lambda app: scopes_task.cancel())
+    if app.get('token-revocations') is not None:
+        loop.run_until_complete(app['token-revocations'].load(app))
+        revocations_task = asyncio.ensure_future(app['token-revocations'].refresh_periodically(app), loop=loop)
+        app.register_on_finish(lambda app: revocations_task.cancel())
+    if app.get('purger') is not None and app['purger'].interval:
+        purge_task = asyncio.ensure_future(app['purger'].run_periodically(app), loop=loop)
+        app.register_on_finish(lambda app: purge_task.cancel())
+
+
+def serve(app, sock):
+    """
+    Serves app on sock until SIGTERM or SIGINT, then stops accepting
+    connections and gives those in progress DRAIN_TIMEOUT seconds to finish.
+    """
+    loop = asyncio.get_event_loop()
+    startup(app, loop)
+
+    handler = app.make_handler(**handler_options())
+    if sock.family == socket.AF_UNIX:
+        srv = loop.run_until_complete(loop.create_unix_server(handler, sock=sock))
+    else:
+        srv = loop.run_until_complete(loop.create_server(handler, sock=sock))
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, loop.stop)
+    logger.info("Server started (pid %d).", os.getpid())
+    if os.environ.get(READY_FD_VARIABLE):
+        # Reloads are handled by the supervisor
+        loop.add_signal_handler(signal.SIGHUP, lambda: None)
+        ready_fd = int(os.environ.pop(READY_FD_VARIABLE))
+        os.write(ready_fd, b'.')
+        os.close(ready_fd)
+    loop.run_forever()
+
+    logger.info("Server stopping; draining connections.")
+    srv.close()
+    loop.run_until_complete(srv.wait_closed())
+    loop.run_until_complete(handler.finish_connections(float(os.environ.get('DRAIN_TIMEOUT', 30))))
+    loop.run_until_complete(app.finish())
+    logger.info("Server finished.")
+
+
+class Worker(object):
+    """
+    A worker process, which reports through a pipe once it's ready to serve.
+    """
+
+    def __init__(self, env, pass_fds):
+        self.ready_fd, child_ready_fd = os.pipe()
+        env = dict(env)
+        env[READY_FD_VARIABLE] = str(child_ready_fd)
+        self.process = subprocess.Popen([sys.executable] + sys.argv, env=env,
+                                        pass_fds=pass_fds + (child_ready_fd,))
+        os.close(child_ready_fd)
+        self.started_at, self.ready = time.monotonic(), False
+        logger.info("Started worker %d", self.process.pid)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def poll(self):
+        if not self.ready and select.select([self.ready_fd], [], [], 0)[0]:
+            # Reads nothing if the worker exited without becoming ready
+            self.ready = bool(os.read(self.ready_fd, 1))
+        return self.process.poll()
+
+    def terminate(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+
+    def close(self):
+        os.close(self.ready_fd)
+
+
+def supervise(workers, sock=None):
+    """
+    Runs and keeps running `workers` copies of this process, which serve on
+    sock if it's given, or otherwise each on one of `workers` sockets bound
+    with SO_REUSEPORT. Either way the supervisor holds the sockets open, and a
+    worker's replacement inherits the same one, so connections waiting in its
+    backlog aren't reset when the worker exits.
+
+    Workers are started afresh rather than forked, so none of them share
+    connections or an event loop with the supervisor. Those that exit
+    unexpectedly are restarted. On SIGTERM or SIGINT, workers are sent SIGTERM
+    and waited for.
+
+    On SIGHUP, a new set of workers is started, picking up any new code and
+    configuration. Once they've all warmed up and are serving, the old ones are
+    sent SIGTERM, and finish what they're doing. If the new workers aren't all
+    ready within RELOAD_TIMEOUT seconds, they're stopped and the old ones kept.
+    """
+    if sock is not None:
+        sockets = [sock] * workers
+    else:
+        sockets = [listening_socket(reuse_port=True) for _ in range(workers)]
+    def start(i):
+        env = dict(os.environ)
+        env[WORKER_FD_VARIABLE] = str(sockets[i].fileno())
+        return Worker(env, (sockets[i].fileno(),))
+    reload_timeout = float(os.environ.get('RELOAD_TIMEOUT', 60))
+
+    stopping, reloading = [], []
+    def stop(signum, frame):
+        stopping.append(signum)
+    def reload(signum, frame):
+        reloading.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+
+    current = [start(i) for i in range(workers)]
+    pending, draining = None, []
+    while not stopping:
+        time.sleep(0.2)
+
+        if reloading and pending is None:
+            del reloading[:]
+            logger.info("Reloading; starting new workers")
+            pending = [start(i) for i in range(workers)]
+            reload_deadline = time.monotonic() + reload_timeout
+        if pending is not None:
+            statuses = [worker.poll() for worker in pending]
+            if all(worker.ready for worker in pending):
+                logger.info("New workers ready; stopping old workers")
+                for worker in current:
+                    worker.terminate()
+                draining.extend(current)
+                current, pending = pending, None
+            elif any(status is not None for status in statuses) or time.monotonic() > reload_deadline:
+                logger.error("New workers failed to start; keeping old workers")
+                for worker in pending:
+                    worker.terminate()
+                draining.extend(pending)
+                pending = None
+
+        for i, worker in enumerate(current):
+            if worker.poll() is None:
+                continue
+            logger.warning("Worker %d exited with status %d", worker.pid, worker.process.returncode)
+            worker.close()
+            # Don't spin if workers are failing on startup
+            if time.monotonic() - worker.started_at < 1:
+                time.sleep(1)
+            current[i] = start(i)
+
+        for worker in draining[:]:
+            if worker.poll() is not None:
+                worker.close()
+                draining.remove(worker)
+
+    logger.info("Stopping workers")
+    everything = current + (pending or []) + draining
+    for worker in everything:
+        worker.terminate()
+    for worker in everything:
+        worker.process.wait()
+    logger.info("Workers stopped.")
+
+
+def run(app):
+    """
+    Serves app in this process, or with WORKERS set, supervises that many
+    worker processes. With REUSE_PORT also set, each worker gets its own TCP
+    socket; otherwise they share one.
+    """
+    if WORKER_FD_VARIABLE in os.environ:
+        fd = int(os.environ[WORKER_FD_VARIABLE])
+        sock = socket.fromfd(fd, _family(), socket.SOCK_STREAM)
+        os.close(fd)
+        sock.setblocking(False)
+        serve(app, sock)
+        return
+
+    workers = int(os.environ.get('WORKERS', 0))
+    if workers and os.environ.get('REUSE_PORT') and not os.environ.get('LISTEN_SOCKET'):
+        supervise(workers)
+    elif workers:
+        supervise(workers, listening_socket())
+    else:
+        serve(app, listening_socket())
@@ -0,0 +1,186 @@
+import asyncio
+import collections
+import json
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['RedisSharedCache', 'MemorySharedCache', 'MemoryStore', 'handle_invalidation']
+
+
+class BaseSharedCache(object):
+    """
+    A cache shared between worker processes, behind each worker's in-process
+    caches.
+
+    Values are stored as JSON, so callers encode anything else (such as
+    datetimes) themselves. Invalidations are published to every other
+    subscribed worker, which is expected to drop its own copies through the
+    callback given to listen(). Only invalidate once the change has been
+    committed, or another worker may share the old value again.
+    """
+
+    def __init__(self, *, ttl=300, prefix='apiox', loop=None):
+        self.ttl, self.prefix = ttl, prefix
+        self.channel = '{}:invalidate'.format(prefix)
+        self.id = uuid.uuid4().hex
+        self._loop = loop or asyncio.get_event_loop()
+
+    def _key(self, namespace, key):
+        return '{}:{}:{}'.format(self.prefix, namespace, key)
+
+    @asyncio.coroutine
+    def get(self, namespace, key):
+        try:
+            value = yield from self._get(self._key(namespace, key))
+        except Exception:
+            logger.exception("Shared cache unavailable")
+            return None
+        return None if value is None else json.loads(value.decode() if isinstance(value, bytes) else value)
+
+    @asyncio.coroutine
+    def set(self, namespace, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl < 1:
+            return
+        try:
+            yield from self._set(self._key(namespace, key),
+                                 json.dumps(value, separators=(',', ':')),
+                                 int(ttl))
+        except Exception:
+            logger.exception("Shared cache unavailable")
+
+    @asyncio.coroutine
+    def invalidate(self, namespace, key):
+        try:
+            yield from self._delete(self._key(namespace, key))
+            yield from self._publish(json.dumps([self.id, namespace, key]))
+        except Exception:
+            logger.exception("Failed to invalidate %s %s in shared cache", namespace, key)
+
+    def invalidate_soon(self, namespace, key):
+        # Safe to call from any thread, including the database executor's, so
+        # can be used from db.on_commit() callbacks
+        def invalidate():
+            asyncio.ensure_future(self.invalidate(namespace, key), loop=self._loop)
+        self._loop.call_soon_threadsafe(invalidate)
+
+    def _received(self, message, callback):
+        origin, namespace, key = json.loads(message)
+        if origin != self.id:
+            callback(namespace, key)
+
+
+class RedisSharedCache(BaseSharedCache):
+    def __init__(self, redis, subscriber, **kwargs):
+        super().__init__(**kwargs)
+        self._redis, self._subscriber = redis, subscriber
+
+    @classmethod
+    @asyncio.coroutine
+    def connect(cls, address, *, loop=None, **kwargs):
+        import aioredis
+        redis = yield from aioredis.create_redis(address, loop=loop)
+        # A connection that's subscribed to a channel can't be used for
+        # anything else
+        subscriber = yield from aioredis.create_redis(address, loop=loop)
+        return cls(redis, subscriber, loop=loop, **kwargs)
+
+    def _get(self, key):
+        return self._redis.get(key)
+
+    def _set(self, key, value, ttl):
+        return self._redis.set(key, value, expire=ttl)
+
+    def _delete(self, key):
+        return self._redis.delete(key)
+
+    def _publish(self, message):
+        return self._redis.publish(self.channel, message)
+
+    @asyncio.coroutine
+    def listen(self, callback):
+        channel, = yield from self._subscriber.subscribe(self.channel)
+        while (yield from channel.wait_message()):
+            message = yield from channel.get(encoding='utf-8')
+            try:
+                self._received(message, callback)
+            except Exception:
+                logger.exception("Failed to handle shared cache invalidation")
+
+    def close(self):
+        self._redis.close()
+        self._subscriber.close()
+
+
+class MemoryStore(object):
+    """
+    Stands in for a Redis server. MemorySharedCaches created with the same
+    store behave like workers sharing one.
+    """
+
+    def __init__(self, *, clock=time.monotonic):
+        self.clock = clock
+        self.data = {}
+        self.subscribers = collections.OrderedDict()
+
+
+class MemorySharedCache(BaseSharedCache):
+    def __init__(self, store=None, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store or MemoryStore()
+
+    @asyncio.coroutine
+    def _get(self, key):
+        try:
+            expires, value = self.store.data[key]
+        except KeyError:
+            return None
+        if expires <= self.store.clock():
+            del self.store.data[key]
+            return None
+        return value
+
+    @asyncio.coroutine
+    def _set(self, key, value, ttl):
+        self.store.data[key] = (self.store.clock() + ttl, value)
+
+    @asyncio.coroutine
+    def _delete(self, key):
+        self.store.data.pop(key, None)
+
+    @asyncio.coroutine
+    def _publish(self, message):
+        for cache, callback in list(self.store.subscribers.values()):
+            cache._loop.call_soon_threadsafe(cache._received, message, callback)
+
+    @asyncio.coroutine
+    def listen(self, callback):
+        self.store.subscribers[self.id] = (self, callback)
+        try:
+            # Stay subscribed until cancelled, like RedisSharedCache.listen()
+            yield from asyncio.Future(loop=self._loop)
+        finally:
+            del self.store.subscribers[self.id]
+
+    def close(self):
+        pass
+
+
+def handle_invalidation(app, namespace, key):
+    """
+    Drops this worker's copy of something another worker has invalidated.
+    """
+    if namespace == 'token':
+        if app.get('token-cache') is not None:
+            app['token-cache'].discard(key)
+    elif namespace == 'principal':
+        if app.get('principal-cache') is not None:
+            app['principal-cache'].discard(key)
+    elif namespace == 'api':
+        from .routing import reload_apis
+        if app.get('scope-cache') is not None:
+            app['scope-cache'].clear()
+        asyncio.ensure_future(reload_apis(app), loop=app.loop)
@@ -0,0 +1,73 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+__all__ = ['Signer']
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class Signer(object):
+    """
+    Signs and verifies JSON-serializable data, with an expiry time.
+
+    Values are signed with the first of `keys`; any of them is accepted when
+    verifying, which allows keys to be rotated by adding a new one at the
+    front and dropping the oldest once everything it signed has expired.
+    """
+
+    class Invalid(Exception):
+        pass
+
+    class Expired(Invalid):
+        pass
+
+    digest = hashlib.sha256
+
+    def __init__(self, keys, *, clock=time.time):
+        if not keys:
+            raise ValueError("At least one key is required")
+        keys = [key.encode() if isinstance(key, str) else key for key in keys]
+        self._keys = {self.key_id(key): key for key in keys}
+        self._signing_key_id = self.key_id(keys[0])
+        self.clock = clock
+
+    @classmethod
+    def key_id(cls, key):
+        return cls.digest(key).hexdigest()[:8]
+
+    def _signature(self, key_id, payload):
+        return _b64encode(hmac.new(self._keys[key_id],
+                                   '{}.{}'.format(key_id, payload).encode(),
+                                   self.digest).digest())
+
+    def sign(self, data, expires_in):
+        payload = _b64encode(json.dumps({'exp': int(self.clock() + expires_in),
+                                         'data': data}, separators=(',', ':')).encode())
+        key_id = self._signing_key_id
+        return '{}.{}.{}'.format(key_id, payload, self._signature(key_id, payload))
+
+    def verify(self, value):
+        try:
+            key_id, payload, signature = value.split('.')
+        except ValueError:
+            raise self.Invalid
+        if key_id not in self._keys:
+            raise self.Invalid
+        if not hmac.compare_digest(signature.encode(), self._signature(key_id, payload).encode()):
+            raise self.Invalid
+        try:
+            payload = json.loads(_b64decode(payload).decode())
+        except ValueError:
+            raise self.Invalid
+        if payload['exp'] <= self.clock():
+            raise self.Expired
+        return payload['data']
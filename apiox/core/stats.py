@@ -0,0 +1,51 @@
+import collections
+import time
+
+__all__ = ['LatencyStats']
+
+
+class LatencyStats(object):
+    """
+    Counts how many times an operation has been performed, how many of those
+    failed, and how long they took.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.count = self.errors = 0
+        self.total = self.max = 0.0
+
+    def observe(self, duration, error=False):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def timer(self):
+        return _Timer(self)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def to_json(self):
+        return collections.OrderedDict([
+            ('count', self.count),
+            ('errors', self.errors),
+            ('total', self.total),
+            ('mean', self.mean),
+            ('max', self.max),
+        ])
+
+
+class _Timer(object):
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = self.stats.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.observe(self.stats.clock() - self.start, error=exc_type is not None)
@@ -1,5 +1,7 @@
-import random
 import hashlib
+import hmac
+import os
+import threading
 
 TOKEN_LENGTH = 32
 TOKEN_LIFETIME = 600
@@ -9,8 +11,96 @@ TOKEN_ALPHABET = 'abcdefghijklmnopqrstuvwxyz' \
 TOKEN_HASH = hashlib.sha256
 TOKEN_HASH_LENGTH = len(TOKEN_HASH(b'').hexdigest())
 
+# Random bytes are mapped onto the alphabet with bytes.translate(). Bytes at or
+# above the largest multiple of the alphabet's length are dropped, so that
+# every character is equally likely.
+_TOKEN_TRANSLATION = bytes(ord(TOKEN_ALPHABET[i % len(TOKEN_ALPHABET)]) for i in range(256))
+_TOKEN_REJECTED = bytes(range(256 - 256 % len(TOKEN_ALPHABET), 256))
+
+
+class TokenGenerator(object):
+    """
+    Generates tokens from os.urandom(), reading it a buffer's worth at a time.
+    """
+
+    def __init__(self, buffer_size=4096):
+        self.buffer_size = buffer_size
+        self._buffer, self._position = '', 0
+        self._lock = threading.Lock()
+
+    def _refill(self, length):
+        buffer = self._buffer[self._position:]
+        while len(buffer) < length:
+            random_bytes = os.urandom(max(self.buffer_size, length))
+            buffer += random_bytes.translate(_TOKEN_TRANSLATION, _TOKEN_REJECTED).decode('ascii')
+        self._buffer, self._position = buffer, 0
+
+    def generate(self, length=TOKEN_LENGTH):
+        with self._lock:
+            if self._position + length > len(self._buffer):
+                self._refill(length)
+            token = self._buffer[self._position:self._position + length]
+            self._position += length
+        return token
+
+
+_token_generator = TokenGenerator()
+
 def generate_token():
-    return ''.join(random.choice(TOKEN_ALPHABET) for _ in range(TOKEN_LENGTH))
+    return _token_generator.generate()
+
+class TokenHasher(object):
+    """
+    Hashes tokens for storage with HMAC, under the first of `keys`.
+
+    Hashes made under any of the other keys, or with the salted hash used
+    before HMAC keys were introduced (if `legacy_salt` isn't None), are still
+    recognised, so keys can be rotated without invalidating existing tokens.
+    Look-ups should match against all of candidates() in one query.
+    """
+
+    def __init__(self, keys=(), *, legacy_salt=None):
+        if isinstance(legacy_salt, str):
+            legacy_salt = legacy_salt.encode()
+        keys = [key.encode() if isinstance(key, str) else key for key in keys]
+        if not keys and legacy_salt is None:
+            raise ValueError("At least one key or a legacy salt is required.")
+        # Keyed once here, and copied for each token
+        self._hmacs = [hmac.new(key, digestmod=TOKEN_HASH) for key in keys]
+        self._legacy_salt = legacy_salt
+
+    def _hmac(self, base, token):
+        h = base.copy()
+        h.update(token.encode())
+        return h.hexdigest()
+
+    def _legacy(self, token):
+        return TOKEN_HASH(token.encode() + self._legacy_salt).hexdigest()
+
+    def hash(self, token):
+        if self._hmacs:
+            return self._hmac(self._hmacs[0], token)
+        return self._legacy(token)
+
+    def hash_many(self, tokens):
+        if self._hmacs:
+            base = self._hmacs[0]
+            return [self._hmac(base, token) for token in tokens]
+        return [self._legacy(token) for token in tokens]
+
+    def candidates(self, token):
+        """
+        Returns the hashes a stored token might have, primary key first.
+        """
+        hashes = [self._hmac(base, token) for base in self._hmacs]
+        if self._legacy_salt is not None:
+            hashes.append(self._legacy(token))
+        return hashes
+
+    def verify(self, token, token_hash):
+        return any(hmac.compare_digest(candidate, token_hash)
+                   for candidate in self.candidates(token))
+
 
 def hash_token(app, token):
-    return TOKEN_HASH(token.encode() + app['token-salt']).hexdigest()
\ No newline at end of file
+    return app['token-hasher'].hash(token)